@@ -0,0 +1,66 @@
+import argparse
+import logging
+import os
+import random
+import tempfile
+import time
+import zipfile
+
+from dedup_images import hash_inputs
+
+
+def build_synthetic_archive(path, num_entries, duplicate_ratio=0.1, entry_size=256, seed=0):
+    """
+    Write a zip archive of num_entries small fake images, roughly duplicate_ratio of which repeat earlier content
+    """
+    rng = random.Random(seed)
+    payloads = []
+    with zipfile.ZipFile(path, 'w') as zip_ref:
+        for i in range(num_entries):
+            if payloads and rng.random() < duplicate_ratio:
+                payload = rng.choice(payloads)
+            else:
+                payload = rng.randbytes(entry_size)
+                if len(payloads) < 1000:
+                    payloads.append(payload)
+            zip_ref.writestr(f"doc_{i // 10:07d}.pptx/ppt/media/image{i % 10}.png", payload)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the hashing phase of dedup_images.py on synthetic archives of "
+                                                 "increasing size. The time per entry should stay flat if the phase "
+                                                 "scales linearly.")
+    parser.add_argument("--sizes", dest="sizes", nargs="+", type=int, default=[10000, 100000, 1000000],
+                        help="Number of entries in each synthetic archive")
+    parser.add_argument("--duplicate_ratio", dest="duplicate_ratio", type=float, default=0.1)
+    parser.add_argument("--entry_size", dest="entry_size", type=int, default=256, help="Bytes per synthetic image")
+    parser.add_argument("--workers", dest="workers", type=int, default=1,
+                        help="Hashing processes, as in dedup_images.py")
+    parser.add_argument("--size_prefilter", dest="size_prefilter", default=False, action="store_true",
+                        help="Use the size and CRC32 prefilter of dedup_images.py, which leaves images with a unique "
+                             "size unhashed. Off by default, so that every entry is hashed.")
+    parser.add_argument("--work_dir", dest="work_dir", help="Where to write the synthetic archives (default: temp dir)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARN)
+
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        print(f"size prefilter: {'on' if args.size_prefilter else 'off'}")
+        print(f"{'entries':>10} {'hashing':>12} {'dataframe':>12} {'us/entry':>10}")
+        for size in args.sizes:
+            archive_path = os.path.join(work_dir, f"synthetic_{size}.zip")
+            build_synthetic_archive(archive_path, size, args.duplicate_ratio, args.entry_size)
+
+            start_time = time.time()
+            processed, unique, duplicates, _ = hash_inputs([archive_path], set(), args.workers, args.size_prefilter)
+            hash_time = time.time() - start_time
+
+            start_time = time.time()
+            processed.to_dataframe()
+            unique.to_dataframe()
+            duplicates.to_dataframe()
+            frame_time = time.time() - start_time
+
+            per_entry = (hash_time + frame_time) / size * 1e6
+            print(f"{size:>10} {hash_time:>11.2f}s {frame_time:>11.2f}s {per_entry:>10.1f}")
+            os.remove(archive_path)
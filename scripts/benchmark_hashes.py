@@ -0,0 +1,43 @@
+import argparse
+import os
+import time
+
+from digests import available_hash_algos, new_hasher
+from dedup_images import HASH_CHUNK_SIZE
+
+# 16 KB icons, 200 KB typical JPEGs, 2 and 10 MB photos
+DEFAULT_SIZES = [16 * 1024, 200 * 1024, 2 * 1024 * 1024, 10 * 1024 * 1024]
+
+
+def measure_throughput(hash_algo, payload, total_bytes):
+    """
+    Hash payload repeatedly, HASH_CHUNK_SIZE at a time as dedup_images.py does, until total_bytes have been hashed.
+    Returns the throughput in MB/s.
+    """
+    repeats = max(1, total_bytes // len(payload))
+    chunks = [payload[i:i + HASH_CHUNK_SIZE] for i in range(0, len(payload), HASH_CHUNK_SIZE)]
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        hasher = new_hasher(hash_algo)
+        for chunk in chunks:
+            hasher.update(chunk)
+        hasher.hexdigest()
+    elapsed = time.perf_counter() - start_time
+    return repeats * len(payload) / elapsed / 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the throughput of the hash algorithms available to "
+                                                 "dedup_images.py on representative image sizes")
+    parser.add_argument("--sizes", dest="sizes", nargs="+", type=int, default=DEFAULT_SIZES,
+                        help="Image sizes in bytes. Default: 16 KB, 200 KB, 2 MB and 10 MB")
+    parser.add_argument("--total_bytes", dest="total_bytes", type=int, default=256 * 1024 * 1024,
+                        help="Bytes to hash per algorithm and image size")
+    args = parser.parse_args()
+
+    hash_algos = available_hash_algos()
+    print(f"{'size':>10} " + " ".join(f"{hash_algo + ' MB/s':>13}" for hash_algo in hash_algos))
+    for size in args.sizes:
+        payload = os.urandom(size)
+        results = [measure_throughput(hash_algo, payload, args.total_bytes) for hash_algo in hash_algos]
+        print(f"{size:>10} " + " ".join(f"{result:>13.1f}" for result in results))
@@ -0,0 +1,224 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import zipfile
+from datetime import datetime
+
+from dedup_images import hash_inputs, output_files
+from filter_files import add_threshold_arguments, iter_verdicts
+from process_files import ZipImageSink, iter_input_files, process_file
+from synthetic_corpus import add_corpus_arguments, corpus_from_args
+from zip_writer import ShardedZipWriter, copy_raw_member, raw_copy_supported
+
+STAGES = ['extract', 'filter', 'dedup_hash', 'dedup_output']
+
+
+def stage_peak_rss_mb():
+    """
+    Peak resident memory of this process in MB, or None where unknown. This is VmHWM, which starts over when a process
+    is spawned, unlike ru_maxrss, which a spawned process inherits from its parent. Worker processes of the stage are
+    not included.
+    """
+    try:
+        with open("/proc/self/status") as ifd:
+            for line in ifd:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def stage_result(seconds, images, num_bytes):
+    peak_rss_mb = stage_peak_rss_mb()
+    return {
+        'seconds': round(seconds, 4),
+        'images': images,
+        'bytes': num_bytes,
+        'images_per_sec': round(images / seconds, 2) if seconds else None,
+        'mb_per_sec': round(num_bytes / seconds / 1e6, 2) if seconds else None,
+        # high watermark of the stage's own process up to the end of the stage
+        'peak_rss_mb': round(peak_rss_mb, 1) if peak_rss_mb is not None else None,
+    }
+
+
+def run_extract(corpus_dir, output_path, work_dir):
+    """
+    process_file() on every file of the corpus into one output archive, as process_files.py --input_dir TRUE does.
+    The bytes are those of the corpus files.
+    """
+    start_time = time.perf_counter()
+    current_index = 0
+    num_bytes = 0
+    with zipfile.ZipFile(output_path, "w") as ofd:
+        sink = ZipImageSink(ofd)
+        for file_path in iter_input_files([corpus_dir]):
+            num_bytes += os.path.getsize(file_path)
+            with open(file_path, "rb") as ifd:
+                current_index = process_file(sink, current_index, file_path, fhandle=ifd, temp_path=work_dir)
+    return {'extract': stage_result(time.perf_counter() - start_time, current_index, num_bytes)}
+
+
+def run_filter(input_path, output_path, workers):
+    """
+    The filter loop of filter_files.py with its default thresholds. The images and bytes are those of the input
+    archive, which all go through the checks.
+    """
+    parser = argparse.ArgumentParser()
+    add_threshold_arguments(parser)
+    args = parser.parse_args([])
+    args.workers, args.measurement_cache, args.dry_run = workers, None, False
+
+    start_time = time.perf_counter()
+    with zipfile.ZipFile(input_path, "r") as ifd, zipfile.ZipFile(output_path, "w") as ofd:
+        items = ifd.infolist()
+        for _, accepted, _ in iter_verdicts([input_path], args):
+            for index in accepted:
+                item = items[index]
+                if raw_copy_supported(item):
+                    copy_raw_member(ifd, item, ofd, item.filename.replace("/", "_"))
+                else:
+                    ofd.writestr(item.filename.replace("/", "_"), ifd.read(item))
+    return {'filter': stage_result(time.perf_counter() - start_time, len(items), sum(item.file_size for item in items))}
+
+
+def run_dedup(input_path, output_path, workers, hash_algo):
+    """
+    The hashing phase of dedup_images.py, then its output phase writing the unique images. The hashing phase counts
+    every image of the input archive, the output phase the unique images it writes.
+    """
+    start_time = time.perf_counter()
+    processed, unique, duplicates, _ = hash_inputs([input_path], set(), workers, hash_algo=hash_algo)
+    with zipfile.ZipFile(input_path, "r") as ifd:
+        hashed_bytes = sum(item.file_size for item in ifd.infolist())
+    results = {'dedup_hash': stage_result(time.perf_counter() - start_time, len(processed), hashed_bytes)}
+
+    start_time = time.perf_counter()
+    unique_df = unique.to_dataframe()
+    with ShardedZipWriter(output_path) as writer:
+        output_files(writer, unique_df, hash_algo)
+    results['dedup_output'] = stage_result(time.perf_counter() - start_time, len(unique_df),
+                                           int(unique_df['file_size'].sum()) if len(unique_df) else 0)
+    return results
+
+
+def _stage_process(results, function, args):
+    logging.basicConfig(level=logging.WARN)
+    try:
+        results.put((True, function(*args)))
+    except Exception as ex:
+        # sent back to be raised in the parent, which would otherwise wait for a result forever
+        results.put((False, RuntimeError(f"{function.__name__} failed: {ex!r}\n{traceback.format_exc()}")))
+
+
+def run_isolated(function, *args):
+    """
+    Run a stage in a fresh process, so that its peak memory use is its own and not that of the stages before it. An
+    exception in the stage is raised here, as is the stage process dying without a result.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    # not a pool worker, so that the stage can start worker processes of its own
+    process = context.Process(target=_stage_process, args=(results, function, args))
+    process.start()
+    while True:
+        try:
+            succeeded, result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError(f"{function.__name__} died with exit code {process.exitcode}")
+    process.join()
+    if not succeeded:
+        raise result
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(report, baseline):
+    """
+    Print the throughput of every stage next to that of a baseline report
+    """
+    print(f"{'stage':>14} {'images/s':>10} {'baseline':>10} {'change':>8} {'peak MB':>8} {'baseline':>8}")
+    for stage in STAGES:
+        current, previous = report['stages'].get(stage), baseline.get('stages', {}).get(stage)
+        if not current or not previous or not previous['images_per_sec']:
+            continue
+        change = (current['images_per_sec'] / previous['images_per_sec'] - 1) * 100
+        print(f"{stage:>14} {current['images_per_sec']:>10.1f} {previous['images_per_sec']:>10.1f} {change:>+7.1f}% "
+              f"{current['peak_rss_mb'] or 0:>8.1f} {previous['peak_rss_mb'] or 0:>8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the throughput (images/s, MB/s) and peak memory use of "
+                                                 "process_file(), the filter loop of filter_files.py and the hashing "
+                                                 "and output phases of dedup_images.py on a synthetic corpus, and "
+                                                 "write the results as JSON")
+    add_corpus_arguments(parser)
+    parser.add_argument("--workers", dest="workers", type=int, default=1,
+                        help="Worker processes of the filter and the dedup hashing")
+    parser.add_argument("--hash_algo", dest="hash_algo", default="md5")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=1,
+                        help="Run every stage this many times and report the fastest run")
+    parser.add_argument("--output", dest="output", help="JSON file to write the results to (default: stdout)")
+    parser.add_argument("--baseline", dest="baseline",
+                        help="JSON results of an earlier run (e.g. the last release) to compare against")
+    parser.add_argument("--work_dir", dest="work_dir",
+                        help="Where to write the corpus and archives (default: temp dir)")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(dir=args.work_dir)
+    try:
+        corpus_dir = os.path.join(work_dir, "corpus")
+        corpus = corpus_from_args(corpus_dir, args)
+        extracted_path = os.path.join(work_dir, "extracted.zip")
+        filtered_path = os.path.join(work_dir, "filtered.zip")
+        unique_path = os.path.join(work_dir, "unique.zip")
+
+        stages = {}
+        for _ in range(args.repeat):
+            for results in (run_isolated(run_extract, corpus_dir, extracted_path, work_dir),
+                            run_isolated(run_filter, extracted_path, filtered_path, args.workers),
+                            run_isolated(run_dedup, filtered_path, unique_path, args.workers, args.hash_algo)):
+                for stage, result in results.items():
+                    if stage not in stages or result['seconds'] < stages[stage]['seconds']:
+                        stages[stage] = result
+    finally:
+        shutil.rmtree(work_dir)
+
+    report = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'options': {'workers': args.workers, 'hash_algo': args.hash_algo, 'repeat': args.repeat},
+        'corpus': corpus,
+        'stages': stages,
+    }
+    if args.output:
+        with open(args.output, "w") as ofd:
+            json.dump(report, ofd, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as ifd:
+            print_comparison(report, json.load(ifd))
@@ -1,16 +1,58 @@
 import argparse
 import logging
+import multiprocessing
 import os
-import hashlib
 import sys
 import time
 import uuid
+from collections import Counter
 from pathlib import Path
 
 import yaml
 import zipfile
 import pandas as pd
 
+from digests import (DEFAULT_HASH_ALGO, HashAlgorithmMismatch, available_hash_algos, check_hash_algo,
+                     new_hasher)
+import metrics
+from hash_store import HashStore
+from zip_writer import COMPRESSION_POLICIES, ShardedZipWriter
+
+# Read size used when streaming zip members through the hash and into the output archives
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Number of archive members hashed by a worker process per task
+HASH_TASK_SIZE = 1000
+
+# Hash of an image that was not hashed because no other image has its size and CRC32, it is filled in while the image
+# is copied to the output
+NOT_HASHED = ''
+
+IMAGE_COLUMNS = ['original_file_name', 'image_id', 'file_ext', 'hash', 'source_archive', 'file_size', 'crc32']
+
+# Only used to copy images into the output zips and to fill the hash store, these are not written to the CSVs
+INTERNAL_COLUMNS = ['source_archive', 'file_size', 'crc32']
+
+
+class ImageRecords:
+    """
+    Column-oriented buffer of image records. Rows are appended to plain lists and the DataFrame is built once at the
+    end, instead of copying the whole frame with pd.concat for every row.
+    """
+
+    def __init__(self, columns):
+        self.columns = {column: [] for column in columns}
+
+    def __len__(self):
+        return len(next(iter(self.columns.values())))
+
+    def append(self, *values):
+        for column, value in zip(self.columns.values(), values):
+            column.append(value)
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.columns, columns=list(self.columns))
+
 
 def load_config(config_path):
     with open(config_path, 'r') as file:
@@ -18,10 +60,10 @@ def load_config(config_path):
     return loaded_data
 
 
-def load_existing_hashes(csv_path):
+def load_existing_hashes(csv_path, hash_algo=DEFAULT_HASH_ALGO):
     """
     Load existing hashes from a CSV file of previous deduplication runs
-    Returns a set of MD5 hashes that are known to be unique
+    Returns a set of hashes that are known to be unique. CSVs without a hash_algo column hold MD5 hashes.
     """
     if not os.path.exists(csv_path):
         logging.info("No existing hash file found at %s", csv_path)
@@ -32,27 +74,271 @@ def load_existing_hashes(csv_path):
         if 'hash' not in df.columns:
             logging.error("Hash column not found in existing hash file")
             return set()
+        for csv_hash_algo in (df['hash_algo'].unique() if 'hash_algo' in df.columns else ['md5']):
+            check_hash_algo(hash_algo, csv_hash_algo, csv_path)
         return set(df['hash'].unique())
+    except HashAlgorithmMismatch:
+        raise
     except Exception as ex:
         logging.error("Error loading existing hashes: %s", str(ex))
         return set()
 
 
+def open_existing_hashes(path, hash_algo=DEFAULT_HASH_ALGO):
+    """
+    The hashes of previous runs from a unique images CSV, or from a hash store for any other path. Returns the hashes
+    to compare against (an empty set without a path) and the hash store, or None if the hashes are not from a store.
+    """
+    if path and path.lower().endswith('.csv'):
+        logging.info("Loading existing hashes from %s", path)
+        existing_hashes = load_existing_hashes(path, hash_algo)
+        logging.info("Loaded %d existing unique hashes", len(existing_hashes))
+        return existing_hashes, None
+    if path:
+        logging.info("Opening hash store %s", path)
+        hash_store = HashStore(path, hash_algo)
+        return hash_store, hash_store
+    return set(), None
+
+
 def init_file_structure(file_path_config):
-    os.makedirs(file_path_config['data_output']['process_images_csv_filename'], exist_ok=True)
-    os.makedirs(file_path_config['data_output']['tmp_working_dir'], exist_ok=True)
+    os.makedirs(file_path_config['data_output']['output_image_csv_dir'], exist_ok=True)
     os.makedirs(file_path_config['data_output']['image_output_dir'], exist_ok=True)
     os.makedirs(file_path_config['data_output']['dedup_log_file_dir'], exist_ok=True)
 
 
-def remove_files_from_dir(dir_path):
-    for file_name in os.listdir(dir_path):
-        file_path = os.path.join(dir_path, file_name)
-        if os.path.isfile(file_path) or os.path.islink(file_path):
+def output_paths(config):
+    """
+    Paths of the CSVs, log file and output zip archives configured in the data_output section of the config
+    """
+    data_output = config['data_output']
+    return {
+        'processed_csv': os.path.join(data_output['output_image_csv_dir'], data_output['process_images_csv_filename']),
+        'unique_csv': os.path.join(data_output['output_image_csv_dir'], data_output['unique_images_csv_filename']),
+        'duplicate_csv': os.path.join(data_output['output_image_csv_dir'],
+                                      data_output['duplicate_images_csv_filename']),
+        'log_file': os.path.join(data_output['dedup_log_file_dir'], data_output['dedup_log_file_name']),
+        'unique_zip': os.path.join(data_output['image_output_dir'], data_output['unique_image_output_filename']),
+        'duplicate_zip': os.path.join(data_output['image_output_dir'],
+                                      data_output['duplicate_image_output_filename']),
+    }
+
+
+def write_image_csvs(paths, image_df, image_unique_df, image_dup_df, hash_algo=DEFAULT_HASH_ALGO):
+    """
+    Write the processed, unique and duplicate image tables to their CSVs without the internal columns, empty tables
+    are not written
+    """
+    for csv_path, df in ((paths['processed_csv'], image_df), (paths['unique_csv'], image_unique_df),
+                         (paths['duplicate_csv'], image_dup_df)):
+        # record the algorithm so that later runs never compare hashes of different algorithms
+        df['hash_algo'] = hash_algo
+        if len(df) > 0:
+            df.drop(columns=INTERNAL_COLUMNS).to_csv(csv_path, index=False, header=True, encoding='utf-8', sep=',')
+
+
+def add_to_hash_store(hash_store, image_unique_df):
+    """
+    Add the hashed unique images of a completed run to the hash store, returns the number of new hashes
+    """
+    stored_df = image_unique_df[image_unique_df['hash'] != NOT_HASHED]
+    return hash_store.add_many(zip(stored_df['hash'],
+                                   stored_df['image_id'],
+                                   stored_df['original_file_name'],
+                                   stored_df['file_size'],
+                                   stored_df['crc32']))
+
+
+def hash_member(zip_ref, entry, hash_algo=DEFAULT_HASH_ALGO, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Compute the hash of a zip member by streaming it straight from the archive, so nothing is extracted to disk
+    """
+    hasher = new_hasher(hash_algo)
+    with zip_ref.open(entry, 'r') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class _HashingReader:
+    """
+    File object wrapper that computes the hash of everything read through it
+    """
+
+    def __init__(self, fileobj, hash_algo=DEFAULT_HASH_ALGO):
+        self.fileobj = fileobj
+        self.hasher = new_hasher(hash_algo)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+def scan_inputs(inputs):
+    """
+    Read the (size, CRC32) of every member of the inputs from their central directories, without reading any data.
+    Returns a list of (zip_path, [(size, crc32), ...]) in input order.
+    """
+    scanned = []
+    for zip_path in inputs:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            scanned.append((zip_path, [(entry.file_size, entry.CRC) for entry in zip_ref.infolist()]))
+    return scanned
+
+
+def select_members_to_hash(scanned, existing_hashes):
+    """
+    Byte-identical images always have the same size and CRC32, so only images that share their (size, CRC32) with
+    another image, or with an image in the hash store, can be duplicates and need to be hashed. Returns the set of
+    member indices to hash for every input, or None for an input whose members all have to be hashed.
+    """
+    if existing_hashes and not (isinstance(existing_hashes, HashStore) and existing_hashes.all_entries_sized()):
+        logging.info("Existing hashes have no sizes to compare against, hashing every image")
+        return [None] * len(scanned)
+
+    key_counts = Counter(key for _, keys in scanned for key in keys)
+    selected = []
+    for zip_path, keys in scanned:
+        selected.append({index for index, key in enumerate(keys)
+                         if key_counts[key] > 1 or (existing_hashes and existing_hashes.contains_size(*key))})
+    return selected
+
+
+def plan_hash_tasks(scanned, selected, hash_algo=DEFAULT_HASH_ALGO, task_size=HASH_TASK_SIZE):
+    """
+    Split the input archives into (zip_path, start, stop, indices to hash, hash_algo) ranges of at most task_size
+    members, in input order
+    """
+    for (zip_path, keys), hash_indices in zip(scanned, selected):
+        for task_start in range(0, len(keys), task_size):
+            task_stop = min(task_start + task_size, len(keys))
+            task_indices = None
+            if hash_indices is not None:
+                task_indices = frozenset(index for index in range(task_start, task_stop) if index in hash_indices)
+            yield zip_path, task_start, task_stop, task_indices, hash_algo
+
+
+# Archive kept open between tasks in a worker process, consecutive tasks usually come from the same archive
+_worker_archive = None
+
+
+def _open_archive(zip_path):
+    global _worker_archive
+    if _worker_archive is None or _worker_archive.filename != zip_path:
+        if _worker_archive is not None:
+            _worker_archive.close()
+        _worker_archive = zipfile.ZipFile(zip_path, 'r')
+    return _worker_archive
+
+
+def _close_archive():
+    global _worker_archive
+    if _worker_archive is not None:
+        _worker_archive.close()
+        _worker_archive = None
+
+
+def hash_archive_members(task):
+    """
+    Hash a range of members of one archive. This runs in the worker processes, so only compact
+    (name, ext, size, crc32, hash) records are sent back. hash is None if the member could not be read and NOT_HASHED
+    if the member did not need to be hashed.
+    """
+    zip_path, task_start, task_stop, hash_indices, hash_algo = task
+    zip_ref = _open_archive(zip_path)
+    members = []
+    for index, entry in enumerate(zip_ref.infolist()[task_start:task_stop], start=task_start):
+        name = entry.filename
+        if name.endswith('/'):
+            continue
+        metrics.add("members_scanned")
+        hash = NOT_HASHED
+        if hash_indices is None or index in hash_indices:
             try:
-                os.remove(file_path)
-            except OSError as e:
-                print(f"Error: {file_path} : {e.strerror}")
+                with metrics.timer("hash"):
+                    hash = hash_member(zip_ref, entry, hash_algo)
+                metrics.add("bytes_hashed", entry.file_size)
+            except Exception as ex:
+                hash = None
+        members.append((name, Path(name).suffix, entry.file_size, entry.CRC, hash))
+    # the metrics of the worker go back to the main process with the hashes
+    return zip_path, members, metrics.REGISTRY.drain()
+
+
+def iter_hashed_members(inputs, existing_hashes, workers=1, size_prefilter=True, hash_algo=DEFAULT_HASH_ALGO,
+                        task_size=HASH_TASK_SIZE):
+    """
+    Yield (zip_path, name, ext, size, crc32, hash) for every member of the input archives, in input order no matter how
+    many worker processes do the hashing
+    """
+    scanned = scan_inputs(inputs)
+    if size_prefilter:
+        selected = select_members_to_hash(scanned, existing_hashes)
+        logging.info("Size/CRC32 prefilter selected %d of %d archive members for hashing",
+                     sum(len(keys) if indices is None else len(indices)
+                         for (_, keys), indices in zip(scanned, selected)),
+                     sum(len(keys) for _, keys in scanned))
+    else:
+        selected = [None] * len(scanned)
+    tasks = plan_hash_tasks(scanned, selected, hash_algo, task_size)
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=metrics.REGISTRY.drain) as pool:
+            # imap hands tasks to whichever worker is free but returns the results in task order
+            for zip_path, members, worker_metrics in pool.imap(hash_archive_members, tasks):
+                metrics.REGISTRY.merge(worker_metrics)
+                for member in members:
+                    yield (zip_path,) + member
+    else:
+        try:
+            for zip_path, members, worker_metrics in map(hash_archive_members, tasks):
+                metrics.REGISTRY.merge(worker_metrics)
+                for member in members:
+                    yield (zip_path,) + member
+        finally:
+            _close_archive()
+
+
+def hash_inputs(inputs, existing_hashes, workers=1, size_prefilter=True, hash_algo=DEFAULT_HASH_ALGO):
+    """
+    Hash every image in the input archives and sort it into the processed, unique and duplicate tables. The first image
+    seen with a hash is the original, every following image with that hash, or with a hash from a previous run, is a
+    duplicate. With size_prefilter, images whose size and CRC32 match no other image are unique without being hashed.
+    Returns the three tables and the number of images that could not be read.
+    """
+    columns = IMAGE_COLUMNS + (['is_duplicate_with_existing'] if existing_hashes else [])
+    processed = ImageRecords(columns)
+    unique = ImageRecords(columns)
+    duplicates = ImageRecords(columns)
+    seen_hashes = set()
+    error_cnt = 0
+    hashed_members = iter_hashed_members(inputs, existing_hashes, workers, size_prefilter, hash_algo)
+    for zip_path, name, ext, size, crc32, hash in hashed_members:
+        image_id = str(uuid.uuid4())
+        logging.info("Processing image: '%s', image_id: %s", name, image_id)
+
+        if hash is None:
+            logging.info("Error processing image. Name = %s, ImageID = %s ", name, image_id)
+            error_cnt = error_cnt + 1
+            continue
+
+        record = [name, image_id, ext, hash, zip_path, size, crc32]
+        is_duplicate_with_existing = hash != NOT_HASHED and hash in existing_hashes
+        if existing_hashes:
+            record.append(is_duplicate_with_existing)
+
+        processed.append(*record)
+        if hash == NOT_HASHED:
+            unique.append(*record)
+        elif is_duplicate_with_existing or hash in seen_hashes:
+            duplicates.append(*record)
+        else:
+            seen_hashes.add(hash)
+            unique.append(*record)
+    return processed, unique, duplicates, error_cnt
 
 
 def format_duration(seconds):
@@ -61,19 +347,43 @@ def format_duration(seconds):
     return f"{int(hours)}h {int(minutes)}m {seconds:.2f}s"
 
 
-def output_files(tmp_wrk_path, output_path, df):
+def output_files(writer, df, hash_algo=DEFAULT_HASH_ALGO):
+    """
+    Copy every image in df straight from its source archive into the output writer under its image_id, without
+    recompressing it where possible. Images that were not hashed yet are decompressed and hashed while they are
+    copied. Returns the number of errors and a dict of image_id to the hashes computed here.
+    """
     file_error_cnt = 0
-    for row in df.itertuples(index=True, name='Pandas'):
-        try:
-            with zipfile.ZipFile(output_path, 'a') as zip_output_unique_ref:
+    copied_hashes = {}
+    source_archives = {}
+    try:
+        for row in df.itertuples(index=True, name='Pandas'):
+            try:
+                if row.source_archive not in source_archives:
+                    source_archives[row.source_archive] = zipfile.ZipFile(row.source_archive, 'r')
+                zip_input_ref = source_archives[row.source_archive]
                 file_name_ext = row.image_id + row.file_ext
-                zip_output_unique_ref.write(os.path.join(tmp_wrk_path, file_name_ext), arcname=file_name_ext)
+                entry = zip_input_ref.getinfo(row.original_file_name)
+                with metrics.timer("write"):
+                    if row.hash == NOT_HASHED:
+                        with zip_input_ref.open(entry, 'r') as image_ifd:
+                            hashing_ifd = _HashingReader(image_ifd, hash_algo)
+                            writer.write_stream(file_name_ext, hashing_ifd, file_size=entry.file_size)
+                        copied_hashes[row.image_id] = hashing_ifd.hexdigest()
+                    else:
+                        # the bytes are unchanged, so the compressed member is copied as is
+                        writer.write_raw(file_name_ext, zip_input_ref, entry)
+                metrics.add("images_written")
+                metrics.add("bytes_out", entry.file_size)
                 logging.info("added file = %s (image_id= %s), to output", row.original_file_name, row.image_id)
-        except Exception as ex:
-            logging.info("Unable to open %s during processing of %s (image_id= %s), error: %s",
-                         output_path, row.original_file_name, row.image_id, str(ex))
-            file_error_cnt = file_error_cnt + 1
-    return file_error_cnt
+            except Exception as ex:
+                logging.info("Unable to write %s during processing of %s (image_id= %s), error: %s",
+                             writer.path, row.original_file_name, row.image_id, str(ex))
+                file_error_cnt = file_error_cnt + 1
+    finally:
+        for zip_input_ref in source_archives.values():
+            zip_input_ref.close()
+    return file_error_cnt, copied_hashes
 
 
 if __name__ == "__main__":
@@ -90,19 +400,57 @@ if __name__ == "__main__":
                         required=True)
     parser.add_argument("--existing_hashes",
                         dest="existing_hashes",
-                        help="CSV file containing hashes from previous deduplication runs to compare against",
+                        help="Hashes from previous deduplication runs to compare against. Either a unique images CSV "
+                             "from a previous run, or a SQLite hash store (any other file name) which is created if "
+                             "it does not exist yet. The unique hashes of this run are added to a hash store once the "
+                             "run completes.",
                         required=False)
     parser.add_argument("--config_file",
                         dest="config_file_loc",
                         help="Override the default location of the config file. Include the file name in the path.")
+    parser.add_argument("--compression",
+                        dest="compression",
+                        choices=COMPRESSION_POLICIES,
+                        default="auto",
+                        help="Compression of the output zip files. 'auto' stores images that are already compressed "
+                             "(JPEG, PNG, ...) and deflates everything else. Default is auto.")
+    parser.add_argument("--shard_max_members",
+                        dest="shard_max_members",
+                        type=int,
+                        help="Roll the output zip files over to a new numbered shard after this many images")
+    parser.add_argument("--shard_max_bytes",
+                        dest="shard_max_bytes",
+                        type=int,
+                        help="Roll the output zip files over to a new numbered shard after this many (compressed) "
+                             "bytes")
+    parser.add_argument("--workers",
+                        dest="workers",
+                        type=int,
+                        default=1,
+                        help="Number of processes used to hash the images. Large archives are split into ranges of "
+                             "members, the results are merged in input order so the first image seen is always the "
+                             "original. Default is 1.")
+    parser.add_argument("--hash_algo",
+                        dest="hash_algo",
+                        choices=available_hash_algos(),
+                        default=DEFAULT_HASH_ALGO,
+                        help="Hash algorithm used to find duplicates. md5 (the default) matches the hashes of earlier "
+                             "runs, xxh3 and blake3 are much faster but need the xxhash or blake3 package. The "
+                             "algorithm is recorded in the CSVs and the hash store, and existing hashes of a different "
+                             "algorithm are refused.")
+    parser.add_argument("--no_size_prefilter",
+                        dest="size_prefilter",
+                        default=True,
+                        action="store_false",
+                        help="Hash every image. By default only images that share their size and CRC32 (read from the "
+                             "zip central directory) with another image, or with an image in the hash store, are "
+                             "hashed before deduplication. The remaining images are unique and are hashed while they "
+                             "are copied to the output.")
+    metrics.add_metrics_arguments(parser)
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO)
 
-    image_df = pd.DataFrame(columns=['original_file_name', 'image_id', 'file_ext', 'hash'])
-    image_unique_df = pd.DataFrame(columns=['original_file_name', 'image_id', 'file_ext', 'hash'])
-    image_dup_df = pd.DataFrame(columns=['original_file_name', 'image_id', 'file_ext', 'hash'])
-
     DEFAULT_CONFIG_PATH = os.path.join('..', 'config', 'dedup_config.yaml')
     if args.config_file_loc:
         DEFAULT_CONFIG_PATH = args.config_file_loc
@@ -110,26 +458,15 @@ if __name__ == "__main__":
     config = load_config(DEFAULT_CONFIG_PATH)
 
     # Load existing hashes if provided
-    existing_hashes = set()
-    if args.existing_hashes:
-        logging.info("Loading existing hashes from %s", args.existing_hashes)
-        existing_hashes = load_existing_hashes(args.existing_hashes)
-        logging.info("Loaded %d existing unique hashes", len(existing_hashes))
+    existing_hashes, hash_store = open_existing_hashes(args.existing_hashes, args.hash_algo)
 
-    PROCESS_IMAGE_FULL_PATH = os.path.join(config['data_output']['output_image_csv_dir'],
-                                           config['data_output']['process_images_csv_filename'])
-    UNIQUE_IMAGE_FULL_PATH = os.path.join(config['data_output']['output_image_csv_dir'],
-                                          config['data_output']['unique_images_csv_filename'])
-    DUPLICATE_IMAGE_FULL_PATH = os.path.join(config['data_output']['output_image_csv_dir'],
-                                             config['data_output']['duplicate_images_csv_filename'])
-    LOG_FILE = os.path.join(config['data_output']['dedup_log_file_dir'],
-                            config['data_output']['dedup_log_file_name'])
-    ZIP_UNIQUE_IMAGE_OUTPUT = os.path.join(config['data_output']['image_output_dir'],
-                                           config['data_output']['unique_image_output_filename'])
-    ZIP_DUPLICATE_IMAGE_OUTPUT = os.path.join(config['data_output']['image_output_dir'],
-                                              config['data_output']['duplicate_image_output_filename'])
-    IMAGE_OUTPUT_DIR = os.path.join(config['data_output']['image_output_dir'])
-    TMP_WRK = os.path.join(config['data_output']['tmp_working_dir'])
+    paths = output_paths(config)
+    PROCESS_IMAGE_FULL_PATH = paths['processed_csv']
+    UNIQUE_IMAGE_FULL_PATH = paths['unique_csv']
+    DUPLICATE_IMAGE_FULL_PATH = paths['duplicate_csv']
+    LOG_FILE = paths['log_file']
+    ZIP_UNIQUE_IMAGE_OUTPUT = paths['unique_zip']
+    ZIP_DUPLICATE_IMAGE_OUTPUT = paths['duplicate_zip']
 
     # count all errors
     error_cnt = 0
@@ -148,68 +485,45 @@ if __name__ == "__main__":
     logging.info("Saving unique image zip file here: %s", ZIP_UNIQUE_IMAGE_OUTPUT)
     logging.info("Saving duplicate image zip file here: %s", ZIP_DUPLICATE_IMAGE_OUTPUT)
 
-    logging.info("Starting MD5 hash computing: " + format_duration(time.time() - start_time))
-    matched_hashes_pd = pd.DataFrame()
-    for zip_path in args.inputs:
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            # Iterate over each item
-            for entry in zip_ref.infolist():
-                name = entry.filename
-                image_id = str(uuid.uuid4())
-                ext = Path(name).suffix
-                image_id_ext = image_id + ext
-
-                if not name.endswith('/'):
-                    logging.info("Processing image: '%s', image_id: %s", name, image_id)
-
-                    try:
-                        zip_ref.extract(name, TMP_WRK)
-                        tmp_path_name = str(os.path.join(TMP_WRK, image_id_ext))
-                        os.rename(str(os.path.join(TMP_WRK, name)), tmp_path_name)
-
-                        hash_md5 = hashlib.md5()
-                        with open(tmp_path_name, 'rb') as f:
-                            for chunk in iter(lambda: f.read(4096), b""):
-                                hash_md5.update(chunk)
-
-                        hash = str(hash_md5.hexdigest())
-
-                        new_record = pd.Series([name,
-                                              image_id,
-                                              ext,
-                                              hash],
-                                             index=image_df.columns)
-
-                        image_df = pd.concat([image_df, pd.DataFrame([new_record])], ignore_index=True)
-                    except Exception as ex:
-                        logging.info("Error processing image. Name = %s, ImageID = %s ", name, image_id)
-                        error_cnt = error_cnt + 1
-
-    logging.info("Finished computing MD5 hashes run time: " + format_duration(time.time() - start_time))
-
-    # Check for duplicates against existing hashes first
-    if existing_hashes:
-        image_df['is_duplicate_with_existing'] = image_df['hash'].isin(existing_hashes)
-        logging.info("Found %d images that match existing hashes",
-                    image_df['is_duplicate_with_existing'].sum())
-
-    # Get unique images (those not in existing hashes and not duplicates in current batch)
-    if existing_hashes:
-        image_unique_df = image_df[~image_df['is_duplicate_with_existing']].drop_duplicates(subset=['hash'])
-    else:
-        image_unique_df = image_df.drop_duplicates(subset=['hash'])
-
-    # Get all duplicated images
-    image_dup_mask = ~image_df['image_id'].isin(image_unique_df['image_id'])
-    image_dup_df = image_df[image_dup_mask]
-
-    logging.info("Starting zip output: " + format_duration(time.time() - start_time))
-
-    if args.output_type.lower() == 'all':
-        error_cnt = error_cnt + output_files(TMP_WRK, ZIP_UNIQUE_IMAGE_OUTPUT, image_unique_df)
-        error_cnt = error_cnt + output_files(TMP_WRK, ZIP_DUPLICATE_IMAGE_OUTPUT, image_dup_df)
-    else:
-        error_cnt = error_cnt + output_files(TMP_WRK, ZIP_UNIQUE_IMAGE_OUTPUT, image_unique_df)
+    with metrics.instrumented(args, "dedup_images"):
+        logging.info("Starting %s hash computing: %s", args.hash_algo, format_duration(time.time() - start_time))
+        processed_records, unique_records, duplicate_records, hash_error_cnt = hash_inputs(
+            args.inputs, existing_hashes, args.workers, args.size_prefilter, args.hash_algo)
+        error_cnt = error_cnt + hash_error_cnt
+
+        logging.info("Finished computing %s hashes run time: %s", args.hash_algo,
+                     format_duration(time.time() - start_time))
+
+        image_df = processed_records.to_dataframe()
+        image_unique_df = unique_records.to_dataframe()
+        image_dup_df = duplicate_records.to_dataframe()
+
+        if existing_hashes:
+            logging.info("Found %d images that match existing hashes",
+                        image_df['is_duplicate_with_existing'].sum())
+
+        logging.info("Starting zip output: " + format_duration(time.time() - start_time))
+
+        output_zips = [(ZIP_UNIQUE_IMAGE_OUTPUT, image_unique_df)]
+        if args.output_type.lower() == 'all':
+            output_zips.append((ZIP_DUPLICATE_IMAGE_OUTPUT, image_dup_df))
+
+        copied_hashes = {}
+        for output_path, output_df in output_zips:
+            with ShardedZipWriter(output_path,
+                                  compression=args.compression,
+                                  max_members=args.shard_max_members,
+                                  max_bytes=args.shard_max_bytes) as writer:
+                output_error_cnt, output_hashes = output_files(writer, output_df, args.hash_algo)
+            error_cnt = error_cnt + output_error_cnt
+            copied_hashes.update(output_hashes)
+            if writer.paths:
+                logging.info("Wrote %s images to: %s", len(output_df), ', '.join(writer.paths))
+
+    # fill in the hashes of the images that skipped hashing thanks to the size/CRC32 prefilter
+    if copied_hashes:
+        for df in (image_df, image_unique_df):
+            df['hash'] = df['image_id'].map(copied_hashes).fillna(df['hash'])
 
     logging.info("Zip output complete: " + format_duration(time.time() - start_time))
     logging.info("Total images processed: %s", len(image_df))
@@ -220,17 +534,11 @@ if __name__ == "__main__":
                     image_df['is_duplicate_with_existing'].sum())
     logging.info("Total errors: %s", error_cnt)
 
-    # cleanup temp dir
-    remove_files_from_dir(TMP_WRK)
-    os.rmdir(TMP_WRK)
-
-    if len(image_df) > 0:
-        image_df.to_csv(PROCESS_IMAGE_FULL_PATH, index=False, header=True, encoding='utf-8', sep=',')
-
-    if len(image_unique_df) > 0:
-        image_unique_df.to_csv(UNIQUE_IMAGE_FULL_PATH, index=False, header=True, encoding='utf-8', sep=',')
+    write_image_csvs(paths, image_df, image_unique_df, image_dup_df, args.hash_algo)
 
-    if len(image_dup_df) > 0:
-        image_dup_df.to_csv(DUPLICATE_IMAGE_FULL_PATH, index=False, header=True, encoding='utf-8', sep=',')
+    if hash_store is not None:
+        added_cnt = add_to_hash_store(hash_store, image_unique_df)
+        logging.info("Added %d new unique hashes to hash store %s", added_cnt, args.existing_hashes)
+        hash_store.close()
 
     logging.info("Total deduplication run time: " + format_duration(time.time() - start_time))
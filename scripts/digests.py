@@ -0,0 +1,63 @@
+import hashlib
+
+# Optional, faster hash implementations. They are only offered when the package is installed.
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# MD5 is kept as the default so that hashes stay comparable with the CSVs of earlier runs
+DEFAULT_HASH_ALGO = 'md5'
+
+HASH_ALGOS = ['md5', 'sha256', 'blake2b', 'xxh3', 'blake3']
+
+
+class HashAlgorithmMismatch(Exception):
+    """
+    Raised when hashes computed with different algorithms would be compared against each other
+    """
+
+
+def available_hash_algos():
+    """
+    The hash algorithms that can be used with the packages installed
+    """
+    return [algo for algo in HASH_ALGOS
+            if (algo != 'xxh3' or xxhash is not None) and (algo != 'blake3' or blake3 is not None)]
+
+
+def new_hasher(algo=DEFAULT_HASH_ALGO):
+    """
+    Create a hash object for algo. All of them offer update() and hexdigest() like the hashlib objects.
+    """
+    if algo == 'md5':
+        return hashlib.md5()
+    if algo == 'sha256':
+        return hashlib.sha256()
+    if algo == 'blake2b':
+        return hashlib.blake2b()
+    if algo == 'xxh3' and xxhash is not None:
+        return xxhash.xxh3_128()
+    if algo == 'blake3' and blake3 is not None:
+        return blake3.blake3()
+    raise ValueError(f"Hash algorithm '{algo}' is not available, choose one of {available_hash_algos()}")
+
+
+def check_hash_algo(expected, found, source):
+    if expected != found:
+        raise HashAlgorithmMismatch(f"{source} holds {found} hashes, but this run uses {expected}")
+
+
+def hash_fileobj(fileobj, algo=DEFAULT_HASH_ALGO, chunk_size=1024 * 1024):
+    """
+    Hash the rest of an open file object, chunk_size bytes at a time
+    """
+    hasher = new_hasher(algo)
+    for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+        hasher.update(chunk)
+    return hasher.hexdigest()
@@ -0,0 +1,92 @@
+import re
+
+# Bytes looked at to classify a file, the tar magic is at offset 257
+SNIFF_SIZE = 512
+
+# Kinds of content
+IMAGE = 'image'
+ZIP = 'zip'
+CFB = 'cfb'
+TAR = 'tar'
+COMPRESSED = 'compressed'
+PDF = 'pdf'
+
+# (signature at the start of the file, kind, format)
+_SIGNATURES = [
+    (b'\xff\xd8\xff', IMAGE, 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', IMAGE, 'png'),
+    (b'GIF87a', IMAGE, 'gif'),
+    (b'GIF89a', IMAGE, 'gif'),
+    (b'II*\x00', IMAGE, 'tiff'),
+    (b'MM\x00*', IMAGE, 'tiff'),
+    # placeable metafile header
+    (b'\xd7\xcd\xc6\x9a', IMAGE, 'wmf'),
+    (b'PK\x03\x04', ZIP, 'zip'),
+    # empty zip archive
+    (b'PK\x05\x06', ZIP, 'zip'),
+    # Compound File Binary, the container of the old Office formats
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', CFB, 'cfb'),
+    (b'\x1f\x8b', COMPRESSED, 'gzip'),
+    (b'BZh', COMPRESSED, 'bzip2'),
+    (b'\xfd7zXZ\x00', COMPRESSED, 'xz'),
+    (b'%PDF-', PDF, 'pdf'),
+]
+
+# File extensions of each image format
+IMAGE_FORMAT_EXTENSIONS = {
+    'jpeg': ['.jpg', '.jpeg'],
+    'png': ['.png'],
+    'gif': ['.gif'],
+    'tiff': ['.tif', '.tiff'],
+    'emf': ['.emf'],
+    'wmf': ['.wmf'],
+}
+
+
+def file_extension(fname):
+    """
+    Lower case extension of a file name including a .tar before it (e.g. '.tar.gz'), or None
+    """
+    ext = re.match(r".*?((\.tar)?\.[^\.]+)$", fname.lower())
+    return ext.group(1) if ext else None
+
+
+def sniff(header):
+    """
+    Classify a file from its first bytes. Returns (kind, format), or (None, None) if the content is not recognised.
+    """
+    for signature, kind, content_format in _SIGNATURES:
+        if header.startswith(signature):
+            return kind, content_format
+    # EMF starts with its header record (type 1) and has its signature at offset 40
+    if header[:4] == b'\x01\x00\x00\x00' and header[40:44] == b' EMF':
+        return IMAGE, 'emf'
+    # metafile header without the placeable header: type 1 or 2, header size of 9 words
+    if header[:4] in (b'\x01\x00\x09\x00', b'\x02\x00\x09\x00') and header[4:6] in (b'\x00\x01', b'\x00\x03'):
+        return IMAGE, 'wmf'
+    if header[257:262] == b'ustar':
+        return TAR, 'tar'
+    return None, None
+
+
+def peek_header(fhandle, size=SNIFF_SIZE):
+    """
+    The first bytes of an open file, without consuming them. Files and zip and tar members are buffered and can be
+    peeked at, other seekable file objects are read and seeked back. Returns b'' for anything else.
+    """
+    if hasattr(fhandle, 'peek'):
+        return fhandle.peek(size)[:size]
+    if fhandle.seekable():
+        position = fhandle.tell()
+        header = fhandle.read(size)
+        fhandle.seek(position)
+        return header
+    return b''
+
+
+def image_formats(image_exts):
+    """
+    The image formats the given image extensions stand for
+    """
+    return {content_format for content_format, extensions in IMAGE_FORMAT_EXTENSIONS.items()
+            if any(ext in extensions for ext in image_exts)}
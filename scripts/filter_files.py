@@ -1,46 +1,321 @@
 import os.path
 import argparse
 import logging
+import multiprocessing
 import zipfile
+from collections import Counter
 from PIL.ImageStat import Stat
 from PIL.Image import open as im_open
 
-if __name__ == "__main__":
+import metrics
+from measurement_cache import MEASUREMENT_COLUMNS, MeasurementCache
+from zip_writer import copy_raw_member, raw_copy_supported
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--output", dest="output", help="Zip archive under which to store filtered files")
-    parser.add_argument("--inputs", dest="inputs", nargs="+", help="Zip archives of unfiltered files")
+# Number of archive members evaluated by a worker process per task
+FILTER_TASK_SIZE = 200
+
+# Threshold values reported by --dry_run
+DIMENSION_STEPS = [0, 50, 100, 150, 200, 300, 400, 600, 800, 1000, 1500, 2000]
+ENTROPY_STEPS = [0.0, 1.0, 2.0, 3.0, 4.0, 4.5, 5.0, 5.5, 6.0, 6.5, 7.0, 7.5]
+
+
+def passes_name_checks(name, file_size, args):
+    """
+    First stage: checks on the name and size of an image, no data is read
+    """
+    if file_size < args.minimum_bytes:
+        return False
+    return "thumb" not in name or args.include_thumbnails
+
+
+def passes_member_checks(item, args):
+    """
+    First stage for an archive member, with the name and size from the zip header
+    """
+    return not item.is_dir() and passes_name_checks(item.filename, item.file_size, args)
+
+
+def passes_dimension_checks(measurements, args):
+    """
+    Second stage: opening an image only parses its header, so width and height are known without decoding it
+    """
+    return measurements['width'] >= args.minimum_width and measurements['height'] >= args.minimum_height
+
+
+def best_entropy(measurements):
+    """
+    The full resolution entropy if it was measured, the reduced decode entropy otherwise
+    """
+    return measurements['entropy'] if measurements['entropy'] is not None else measurements['draft_entropy']
+
+
+def decide(measurements, args):
+    """
+    Decide on an image from its measurements: True or False, or None if the entropy measured so far is not enough
+    """
+    if measurements['width'] is None or not passes_dimension_checks(measurements, args):
+        return False
+    if measurements['entropy'] is not None:
+        return measurements['entropy'] >= args.minimum_entropy
+    if (measurements['draft_entropy'] is not None and measurements['draft_size'] == args.entropy_draft_size and
+            abs(measurements['draft_entropy'] - args.minimum_entropy) > args.entropy_tolerance):
+        return measurements['draft_entropy'] >= args.minimum_entropy
+    return None
+
+
+def _measure_entropy(im, args, measurements):
+    # JPEGs are decoded at a reduced scale with draft(), other formats ignore it and are measured at full resolution
+    full_size = im.size
+    if args.entropy_draft_size:
+        im.draft(None, (args.entropy_draft_size, args.entropy_draft_size))
+    entropy = im.entropy()
+    if im.size == full_size:
+        measurements['entropy'] = entropy
+    else:
+        measurements['draft_size'], measurements['draft_entropy'] = args.entropy_draft_size, entropy
+
+
+def measure_image(open_image, args, cached=None, complete=False):
+    """
+    Dimension and entropy stages. Entropy needs the decoded pixels, so JPEGs are first decoded at a reduced scale with
+    draft(), which is several times cheaper. Only if that entropy is within entropy_tolerance of the threshold is the
+    image decoded again at full resolution to make an exact decision. Measurements from the cache are used as far as
+    they go. With complete, the entropy is measured even for images that fail the dimension checks. open_image returns
+    a new file object of the image every time it is called. Returns (accepted, measurements).
+    """
+    measurements = dict(cached) if cached else None
+    if measurements is None:
+        with im_open(open_image()) as im:
+            measurements = dict.fromkeys(MEASUREMENT_COLUMNS)
+            measurements.update(format=im.format, width=im.width, height=im.height)
+            if complete or passes_dimension_checks(measurements, args):
+                _measure_entropy(im, args, measurements)
+
+    accepted = decide(measurements, args)
+    needs_entropy = accepted is None or (complete and measurements['width'] is not None)
+    if needs_entropy and measurements['entropy'] is None and args.entropy_draft_size and \
+            measurements['draft_size'] != args.entropy_draft_size:
+        with im_open(open_image()) as im:
+            _measure_entropy(im, args, measurements)
+        accepted = decide(measurements, args)
+    if accepted is None:
+        with im_open(open_image()) as im:
+            measurements['entropy'] = im.entropy()
+        accepted = decide(measurements, args)
+    return accepted, measurements
+
+
+def accept_member(ifd, item, args, cached=None):
+    """
+    Run every filter stage on one archive member. Returns whether it is kept, and the measurements of images (None for
+    members that were not decoded).
+    """
+    if not passes_member_checks(item, args):
+        return False, None
+    if item.filename.endswith("pdf"):
+        return args.include_pdfs, None
+    try:
+        with metrics.timer("decode"):
+            return measure_image(lambda: ifd.open(item), args, cached, complete=args.dry_run)
+    except Exception as e:
+        logging.info("Couldn't read image file '%s', error: %s", item.filename, str(e))
+        # remembered as unreadable, so that re-runs do not try again
+        return False, dict.fromkeys(MEASUREMENT_COLUMNS)
+
+
+def plan_filter_tasks(inputs, args, task_size=FILTER_TASK_SIZE):
+    """
+    Split the input archives into (archive, start, stop, args) ranges of at most task_size members, in input order
+    """
+    for ifname in inputs:
+        try:
+            with zipfile.ZipFile(ifname, "r") as ifd:
+                num_items = len(ifd.infolist())
+        except zipfile.BadZipFile:
+            logging.info("Skipping '%s', not a zip archive", ifname)
+            continue
+        for task_start in range(0, num_items, task_size):
+            yield ifname, task_start, min(task_start + task_size, num_items), args
+
+
+# Archive and measurement cache kept open between tasks in a worker process, consecutive tasks usually come from the
+# same archive
+_worker_archive = None
+_worker_cache = None
+
+
+def _open_archive(ifname):
+    global _worker_archive
+    if _worker_archive is None or _worker_archive.filename != ifname:
+        if _worker_archive is not None:
+            _worker_archive.close()
+        _worker_archive = zipfile.ZipFile(ifname, "r")
+    return _worker_archive
+
+
+def _open_cache(path):
+    global _worker_cache
+    if _worker_cache is None:
+        _worker_cache = MeasurementCache(path)
+    return _worker_cache
+
+
+def filter_members(task):
+    """
+    Evaluate the filter on a range of members of one archive. This runs in the worker processes, which open the
+    archive themselves and only send back the indices of the members to keep and the measurements of the images. Each
+    measurement is (index, measurements, whether they are new), the cache is only written by the main process.
+    """
+    ifname, task_start, task_stop, args = task
+    ifd = _open_archive(ifname)
+    cache = _open_cache(args.measurement_cache) if args.measurement_cache else None
+    archive_key = os.path.abspath(ifname)
+    accepted, measured = [], []
+    for index, item in enumerate(ifd.infolist()[task_start:task_stop], start=task_start):
+        metrics.add("members_scanned")
+        metrics.add("bytes_in", item.file_size)
+        cached = cache.get(archive_key, item) if cache is not None else None
+        if cached is not None:
+            metrics.add("cache_hits")
+        keep, measurements = accept_member(ifd, item, args, cached)
+        if keep:
+            accepted.append(index)
+        if measurements is not None:
+            measured.append((index, measurements, measurements != cached))
+    # the metrics of the worker go back to the main process with the verdicts
+    return ifname, accepted, measured, metrics.REGISTRY.drain()
+
+
+def _merge_worker_metrics(result):
+    *verdicts, worker_metrics = result
+    metrics.REGISTRY.merge(worker_metrics)
+    return tuple(verdicts)
+
+
+def iter_verdicts(inputs, args):
+    """
+    Yield (archive, indices of the members to keep, measurements) for every task, in input order no matter how many
+    workers run
+    """
+    tasks = plan_filter_tasks(inputs, args)
+    if args.workers > 1:
+        with multiprocessing.Pool(args.workers, initializer=metrics.REGISTRY.drain) as pool:
+            # imap hands tasks to whichever worker is free but returns the results in task order
+            yield from map(_merge_worker_metrics, pool.imap(filter_members, tasks))
+    else:
+        yield from map(_merge_worker_metrics, map(filter_members, tasks))
+
+
+def print_threshold_histograms(measurements, args):
+    """
+    Print how many images each value of a threshold would keep, with the other thresholds at their current values.
+    Entropies that were only measured on a reduced decode are counted as such, so the counts near a threshold can be
+    off by the images within --entropy_tolerance of it.
+    """
+    readable = [m for m in measurements if m['width'] is not None]
+    width_ok = [m['width'] >= args.minimum_width for m in readable]
+    height_ok = [m['height'] >= args.minimum_height for m in readable]
+    entropy_ok = [best_entropy(m) >= args.minimum_entropy for m in readable]
+    print(f"{len(measurements)} images, {len(measurements) - len(readable)} unreadable, "
+          f"{sum(w and h and e for w, h, e in zip(width_ok, height_ok, entropy_ok))} kept with the current thresholds")
+    formats = Counter(m['format'] for m in readable)
+    print("Formats: " + ", ".join(f"{image_format} {count}" for image_format, count in formats.most_common()))
+
+    for option, thresholds, keeps in [
+        ("--minimum_width", DIMENSION_STEPS,
+         lambda t: sum(m['width'] >= t and h and e for m, h, e in zip(readable, height_ok, entropy_ok))),
+        ("--minimum_height", DIMENSION_STEPS,
+         lambda t: sum(m['height'] >= t and w and e for m, w, e in zip(readable, width_ok, entropy_ok))),
+        ("--minimum_entropy", ENTROPY_STEPS,
+         lambda t: sum(best_entropy(m) >= t and w and h for m, w, h in zip(readable, width_ok, height_ok))),
+    ]:
+        print(f"{option:>18} {'kept':>10}")
+        for threshold in thresholds:
+            print(f"{threshold:>18} {keeps(threshold):>10}")
+
+
+def add_threshold_arguments(parser):
+    """
+    Add the options of the filter checks to an argument parser
+    """
     parser.add_argument("--minimum_entropy", dest="minimum_entropy", default=6.0, type=float)
     parser.add_argument("--minimum_width", dest="minimum_width", default=200, type=int)
     parser.add_argument("--minimum_height", dest="minimum_height", default=200, type=int)
+    parser.add_argument("--minimum_bytes", dest="minimum_bytes", default=0, type=int,
+                        help="Skip files smaller than this many bytes without opening them")
+    parser.add_argument("--entropy_draft_size", dest="entropy_draft_size", default=512, type=int,
+                        help="Compute the entropy of JPEGs on a reduced decode that is at least this many pixels wide "
+                             "and high. 0 always decodes at full resolution.")
+    parser.add_argument("--entropy_tolerance", dest="entropy_tolerance", default=0.5, type=float,
+                        help="If the entropy of the reduced decode is within this distance of --minimum_entropy, the "
+                             "image is decoded at full resolution to decide")
     parser.add_argument("--include_pdfs", dest="include_pdfs", default=False, action="store_true")
     parser.add_argument("--include_thumbnails", dest="include_thumbnails", default=False, action="store_true")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", dest="output", help="Zip archive under which to store filtered files")
+    parser.add_argument("--inputs", dest="inputs", nargs="+", help="Zip archives of unfiltered files")
+    add_threshold_arguments(parser)
+    parser.add_argument("--workers", dest="workers", default=1, type=int,
+                        help="Number of processes evaluating the filter. The accepted images are written by a single "
+                             "writer in input order, so the output does not depend on the number of workers.")
+    parser.add_argument("--measurement_cache", dest="measurement_cache",
+                        help="SQLite file (created if missing) in which the width, height and entropy of every image "
+                             "are kept, so that re-runs with other thresholds do not decode the images again")
+    parser.add_argument("--dry_run", dest="dry_run", default=False, action="store_true",
+                        help="Write no output, measure every image and print how many images each threshold value "
+                             "would keep")
+    metrics.add_metrics_arguments(parser)
     args = parser.parse_args()
+    if not args.output and not args.dry_run:
+        parser.error("--output is required unless --dry_run is given")
 
     logging.basicConfig(level=logging.INFO)
 
-    ofd_zip = zipfile.ZipFile(args.output, "w")
-    for ifname in args.inputs:
-        logging.info("Processing file '%s'", ifname)
-        try:
-            with zipfile.ZipFile(ifname, "r") as ifd:
-                for i, item in enumerate(ifd.infolist()):
-                    if ("thumb" not in item.filename or args.include_thumbnails) and not item.is_dir():
-                        fname = item.filename.replace("/", "_")
-                        if item.filename.endswith("pdf"):
-                            if args.include_pdfs:
-                                with ofd_zip.open(fname, "w") as ofd:
-                                    ofd.write(ifd.read(item))
+    cache = MeasurementCache(args.measurement_cache) if args.measurement_cache else None
+    ofd_zip = None if args.dry_run else zipfile.ZipFile(args.output, "w")
+    dry_run_measurements = []
+    # a single writer copies the accepted members in input order, whichever worker evaluated them, and stores the new
+    # measurements in the cache
+    current_ifname, current_ifd = None, None
+    try:
+        with metrics.instrumented(args, "filter_files"):
+            for ifname, accepted, measured in iter_verdicts(args.inputs, args):
+                if ifname != current_ifname:
+                    logging.info("Processing file '%s'", ifname)
+                    if current_ifd is not None:
+                        current_ifd.close()
+                    current_ifname, current_ifd = ifname, zipfile.ZipFile(ifname, "r")
+                items = current_ifd.infolist()
+                if cache is not None:
+                    cache.put_many(os.path.abspath(ifname),
+                                   [(items[index].filename, items[index].CRC, items[index].file_size, measurements)
+                                    for index, measurements, is_new in measured if is_new])
+                if args.dry_run:
+                    dry_run_measurements.extend(measurements for _, measurements, _ in measured)
+                    continue
+                for index in accepted:
+                    item = items[index]
+                    arcname = item.filename.replace("/", "_")
+                    with metrics.timer("write"):
+                        if raw_copy_supported(item):
+                            # accepted images are unchanged, so the compressed bytes are copied without inflating them
+                            copy_raw_member(current_ifd, item, ofd_zip, arcname)
                         else:
-                            try:
-                                im = im_open(ifd.open(item))
-                                entropy = im.entropy()
-                                if entropy >= args.minimum_entropy and (im.width >= args.minimum_width and im.height >= args.minimum_height):
-                                    with ofd_zip.open(fname, "w") as ofd:
-                                        ofd.write(ifd.read(item))
-                            except Exception as e:
-                                logging.info("Couldn't read image file '%s'", item.filename)
-                                print(e)
-        except zipfile.BadZipFile:
-            pass
-            
+                            with ofd_zip.open(arcname, "w") as ofd:
+                                ofd.write(current_ifd.read(item))
+                    metrics.add("images_kept")
+                    metrics.add("bytes_out", item.file_size)
+    finally:
+        if current_ifd is not None:
+            current_ifd.close()
+        if ofd_zip is not None:
+            ofd_zip.close()
+        if cache is not None:
+            cache.close()
+
+    if args.dry_run:
+        print_threshold_histograms(dry_run_measurements, args)
@@ -0,0 +1,131 @@
+import argparse
+import logging
+import sqlite3
+
+import pandas as pd
+
+from digests import DEFAULT_HASH_ALGO, HashAlgorithmMismatch, HASH_ALGOS, check_hash_algo
+
+
+def _optional_int(value):
+    # pandas hands back numpy integers, which sqlite3 cannot bind
+    return None if value is None else int(value)
+
+
+class HashStore:
+    """
+    Persistent index of the hashes of the unique images from previous deduplication runs. The hashes are kept in
+    SQLite as binary digests under a primary key, so opening the store costs nothing and every membership check is an
+    index lookup instead of a scan of the previous run's CSV. The size and CRC32 of every image are indexed as well, so
+    that the dedup size prefilter can tell which new images could match a stored one. A store only ever holds hashes of
+    one algorithm, opening it with another one raises HashAlgorithmMismatch.
+    """
+
+    def __init__(self, path, hash_algo=DEFAULT_HASH_ALGO):
+        self.path = path
+        self.hash_algo = hash_algo
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS hashes ("
+                                    "digest BLOB PRIMARY KEY, "
+                                    "image_id TEXT, "
+                                    "original_file_name TEXT, "
+                                    "file_size INTEGER, "
+                                    "crc32 INTEGER"
+                                    ") WITHOUT ROWID")
+            # stores created before sizes were recorded
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(hashes)")]
+            for column in ['file_size', 'crc32']:
+                if column not in columns:
+                    self.connection.execute(f"ALTER TABLE hashes ADD COLUMN {column} INTEGER")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS hashes_size_crc32 ON hashes (file_size, crc32)")
+
+            row = self.connection.execute("SELECT value FROM metadata WHERE key = 'hash_algo'").fetchone()
+            if row is None:
+                # stores created before the algorithm was recorded only ever held MD5 hashes
+                has_hashes = self.connection.execute("SELECT 1 FROM hashes LIMIT 1").fetchone() is not None
+                stored_hash_algo = 'md5' if has_hashes else hash_algo
+                self.connection.execute("INSERT INTO metadata VALUES ('hash_algo', ?)", (stored_hash_algo,))
+            else:
+                stored_hash_algo = row[0]
+        try:
+            check_hash_algo(hash_algo, stored_hash_algo, path)
+        except HashAlgorithmMismatch:
+            self.connection.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __bool__(self):
+        # an open store is always used for comparisons, even before the first run has added anything to it
+        return True
+
+    def __contains__(self, hash):
+        cursor = self.connection.execute("SELECT 1 FROM hashes WHERE digest = ?", (bytes.fromhex(hash),))
+        return cursor.fetchone() is not None
+
+    def contains_size(self, file_size, crc32):
+        cursor = self.connection.execute("SELECT 1 FROM hashes WHERE file_size = ? AND crc32 = ?", (file_size, crc32))
+        return cursor.fetchone() is not None
+
+    def all_entries_sized(self):
+        """
+        Whether every stored hash has a size and CRC32, hashes imported from CSVs do not
+        """
+        cursor = self.connection.execute("SELECT 1 FROM hashes WHERE file_size IS NULL OR crc32 IS NULL LIMIT 1")
+        return cursor.fetchone() is None
+
+    def count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM hashes").fetchone()[0]
+
+    def add_many(self, records):
+        """
+        Add (hash, image_id, original_file_name, file_size, crc32) records in a single transaction, hashes already in
+        the store are left untouched. Returns the number of hashes added.
+        """
+        before = self.connection.total_changes
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO hashes "
+                                        "(digest, image_id, original_file_name, file_size, crc32) "
+                                        "VALUES (?, ?, ?, ?, ?)",
+                                        ((bytes.fromhex(hash), image_id, name, _optional_int(file_size),
+                                          _optional_int(crc32))
+                                         for hash, image_id, name, file_size, crc32 in records))
+        return self.connection.total_changes - before
+
+    def import_csv(self, csv_path):
+        """
+        Add the hashes of a unique images CSV written by a previous deduplication run. The CSVs do not record sizes,
+        so a store with imported hashes makes the dedup size prefilter fall back to hashing every image.
+        """
+        df = pd.read_csv(csv_path)
+        for csv_hash_algo in (df['hash_algo'].unique() if 'hash_algo' in df.columns else ['md5']):
+            check_hash_algo(self.hash_algo, csv_hash_algo, csv_path)
+        return self.add_many((hash, image_id, name, None, None)
+                             for hash, image_id, name in zip(df['hash'], df['image_id'], df['original_file_name']))
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or extend a hash store from the unique images CSVs of "
+                                                 "previous deduplication runs")
+    parser.add_argument("--store", dest="store", help="SQLite hash store to create or add to", required=True)
+    parser.add_argument("--import_csv", dest="import_csv", nargs="+", help="Unique images CSVs to import",
+                        required=True)
+    parser.add_argument("--hash_algo", dest="hash_algo", choices=HASH_ALGOS, default=DEFAULT_HASH_ALGO,
+                        help="Hash algorithm of the store and of the imported CSVs. Default is md5.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    with HashStore(args.store, args.hash_algo) as store:
+        for csv_path in args.import_csv:
+            logging.info("Imported %d new hashes from %s", store.import_csv(csv_path), csv_path)
+        logging.info("Hash store %s now holds %d hashes", args.store, store.count())
@@ -0,0 +1,68 @@
+import sqlite3
+
+# Per-image measurements of the filter, an image that could not be decoded has all of them set to None
+MEASUREMENT_COLUMNS = ['format', 'width', 'height', 'draft_size', 'draft_entropy', 'entropy']
+
+
+class MeasurementCache:
+    """
+    Persistent per-image measurements of filter_files.py (format, width, height and entropy), so that a re-run with
+    other thresholds looks the images up instead of decoding them again. Measurements are keyed by archive path and
+    member name, and are only used while the member's CRC32 and size are unchanged. Several processes can read the
+    cache at once while one of them writes to it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS measurements ("
+                                    "archive TEXT, "
+                                    "member TEXT, "
+                                    "crc32 INTEGER, "
+                                    "file_size INTEGER, "
+                                    "format TEXT, "
+                                    "width INTEGER, "
+                                    "height INTEGER, "
+                                    "draft_size INTEGER, "
+                                    "draft_entropy REAL, "
+                                    "entropy REAL, "
+                                    "PRIMARY KEY (archive, member)"
+                                    ") WITHOUT ROWID")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, archive, item):
+        """
+        Measurements of the zip member item of archive as a dict, or None if it was not measured in its current version
+        """
+        cursor = self.connection.execute(f"SELECT crc32, file_size, {', '.join(MEASUREMENT_COLUMNS)} "
+                                         "FROM measurements WHERE archive = ? AND member = ?", (archive, item.filename))
+        row = cursor.fetchone()
+        if row is None or row[0] != item.CRC or row[1] != item.file_size:
+            return None
+        return dict(zip(MEASUREMENT_COLUMNS, row[2:]))
+
+    def put_many(self, archive, records):
+        """
+        Store (member name, crc32, file_size, measurements) records of archive in a single transaction, replacing the
+        previous measurements of the members
+        """
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO measurements "
+                                        f"(archive, member, crc32, file_size, {', '.join(MEASUREMENT_COLUMNS)}) "
+                                        f"VALUES (?, ?, ?, ?, {', '.join('?' * len(MEASUREMENT_COLUMNS))})",
+                                        ((archive, name, crc32, file_size,
+                                          *(measurements[column] for column in MEASUREMENT_COLUMNS))
+                                         for name, crc32, file_size, measurements in records))
+
+    def count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM measurements").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
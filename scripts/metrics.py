@@ -0,0 +1,205 @@
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket takes everything above
+LATENCY_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0]
+
+# Seconds between two writes of the metrics file
+DEFAULT_METRICS_INTERVAL = 60
+
+
+class Metrics:
+    """
+    Counters (e.g. bytes_in, images_kept) and per-stage latency histograms (e.g. time in decode, hash or write) of a
+    run. Updates are cheap and thread-safe. Worker processes collect into their own registry, which they drain and
+    send back with their results to be merged into the registry of the main process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = Counter()
+        # stage -> [bucket counts..., count above the last bucket], total seconds
+        self.histograms = {}
+        self.seconds = Counter()
+
+    def _after_fork(self):
+        # a fork while another thread (e.g. the metrics writer) held the lock would leave it held in the child for good
+        self._lock = threading.Lock()
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            buckets = self.histograms.get(stage)
+            if buckets is None:
+                buckets = self.histograms[stage] = [0] * (len(LATENCY_BUCKETS) + 1)
+            buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self.seconds[stage] += seconds
+
+    @contextmanager
+    def timer(self, stage):
+        """
+        Time the body of a with statement as one observation of stage
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start_time)
+
+    def drain(self):
+        """
+        Everything collected so far as plain data, and start over
+        """
+        with self._lock:
+            drained = dict(self.counters), {stage: list(buckets) for stage, buckets in self.histograms.items()}, \
+                dict(self.seconds)
+            self.counters.clear()
+            self.histograms.clear()
+            self.seconds.clear()
+        return drained
+
+    def merge(self, drained):
+        counters, histograms, seconds = drained
+        with self._lock:
+            self.counters.update(counters)
+            for stage, buckets in histograms.items():
+                merged = self.histograms.setdefault(stage, [0] * (len(LATENCY_BUCKETS) + 1))
+                for index, count in enumerate(buckets):
+                    merged[index] += count
+            self.seconds.update(seconds)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'stages': {stage: {'count': sum(buckets),
+                                   'seconds': round(self.seconds[stage], 6),
+                                   'buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], buckets))}
+                           for stage, buckets in self.histograms.items()},
+            }
+
+    def to_prometheus(self, job):
+        """
+        The metrics in the Prometheus text format, as read by the textfile collector of the node exporter
+        """
+        snapshot = self.to_dict()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f"# TYPE oida_{name}_total counter")
+            lines.append(f'oida_{name}_total{{job="{job}"}} {value}')
+        if snapshot['stages']:
+            lines.append("# TYPE oida_stage_seconds histogram")
+        for stage, histogram in sorted(snapshot['stages'].items()):
+            labels = f'job="{job}",stage="{stage}"'
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append(f'oida_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"oida_stage_seconds_sum{{{labels}}} {histogram['seconds']}")
+            lines.append(f"oida_stage_seconds_count{{{labels}}} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+# The registry the scripts collect into
+REGISTRY = Metrics()
+add = REGISTRY.add
+timer = REGISTRY.timer
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=REGISTRY._after_fork)
+
+
+def write_metrics(path, job, start_time, registry=REGISTRY):
+    """
+    Write the metrics to path, in the Prometheus text format if it ends in .prom and as JSON otherwise. The file is
+    replaced at once, so a reader never sees half of it.
+    """
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as ofd:
+        if path.endswith(".prom"):
+            ofd.write(registry.to_prometheus(job))
+            ofd.write(f"# TYPE oida_elapsed_seconds gauge\noida_elapsed_seconds{{job=\"{job}\"}} "
+                      f"{time.time() - start_time:.1f}\n")
+        else:
+            json.dump(dict(job=job, elapsed_seconds=round(time.time() - start_time, 1), **registry.to_dict()), ofd,
+                      indent=2)
+    os.replace(temp_path, path)
+
+
+class MetricsWriter:
+    """
+    Background thread writing the metrics to a file every interval seconds, and a last time when it is stopped
+    """
+
+    def __init__(self, path, job, interval=DEFAULT_METRICS_INTERVAL, registry=REGISTRY):
+        self.path = path
+        self.job = job
+        self.interval = interval
+        self.registry = registry
+        self.start_time = time.time()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                write_metrics(self.path, self.job, self.start_time, self.registry)
+            except OSError as ex:
+                logging.info("Unable to write metrics to %s, error: %s", self.path, str(ex))
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        write_metrics(self.path, self.job, self.start_time, self.registry)
+
+
+def add_metrics_arguments(parser):
+    """
+    Add the metrics and profiling options to an argument parser
+    """
+    parser.add_argument("--metrics", dest="metrics",
+                        help="File to write counters and per-stage latency histograms to while the script runs, in "
+                             "the Prometheus text format if the name ends in .prom (for the node exporter's textfile "
+                             "collector) and as JSON otherwise")
+    parser.add_argument("--metrics_interval", dest="metrics_interval", default=DEFAULT_METRICS_INTERVAL, type=int,
+                        help="Seconds between two writes of the --metrics file")
+    parser.add_argument("--profile", dest="profile",
+                        help="Write cProfile statistics of the main loop to this file, e.g. to read with pstats or "
+                             "snakeviz")
+
+
+@contextmanager
+def instrumented(args, job):
+    """
+    Collect the metrics of the body of a with statement to args.metrics, and profile it to args.profile, as asked for
+    on the command line
+    """
+    writer = None
+    if args.metrics:
+        writer = MetricsWriter(args.metrics, job, args.metrics_interval)
+        writer.start()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield REGISTRY
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logging.info("Wrote profile to %s", args.profile)
+        if writer is not None:
+            writer.stop()
+            logging.info("Wrote metrics to %s", args.metrics)
@@ -0,0 +1,254 @@
+import argparse
+import logging
+import os
+import sys
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+import yaml
+from PIL import Image
+
+PERCEPTUAL_HASH_TYPES = ['ahash', 'dhash', 'phash']
+
+# Side of the downscaled image the DCT of the pHash is computed on
+PHASH_IMAGE_SIZE = 32
+
+# Number of images whose perceptual hashes are computed together in one vectorized NumPy call
+HASH_BATCH_SIZE = 256
+
+
+def load_config(config_path):
+    with open(config_path, 'r') as file:
+        loaded_data = yaml.safe_load(file)
+    return loaded_data
+
+
+def format_duration(seconds):
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{int(hours)}h {int(minutes)}m {seconds:.2f}s"
+
+
+def hash_input_size(hash_type, hash_size):
+    """
+    (width, height) the images are downscaled to before hashing
+    """
+    if hash_type == 'dhash':
+        return hash_size + 1, hash_size
+    if hash_type == 'phash':
+        return PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE
+    return hash_size, hash_size
+
+
+def load_pixels(fhandle, size):
+    """
+    Decode an image to a downscaled grayscale array. JPEGs are decoded at a reduced scale with draft(), which is much
+    cheaper than decoding at full resolution.
+    """
+    with Image.open(fhandle) as im:
+        im.draft('L', (size[0] * 4, size[1] * 4))
+        return np.asarray(im.convert('L').resize(size, Image.LANCZOS), dtype=np.float32)
+
+
+def dct_matrix(n):
+    """
+    Orthonormal DCT-II matrix, so that the 2D DCT of a batch X is D @ X @ D.T
+    """
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0, :] = np.sqrt(1 / n)
+    return matrix.astype(np.float32)
+
+
+def perceptual_hashes(pixels, hash_type, hash_size):
+    """
+    Compute the perceptual hashes of a batch of downscaled images (an array of shape (N, height, width)) at once.
+    Returns one hash_size * hash_size bit integer per image.
+    """
+    if hash_type == 'ahash':
+        bits = pixels > pixels.mean(axis=(1, 2), keepdims=True)
+    elif hash_type == 'dhash':
+        bits = pixels[:, :, 1:] > pixels[:, :, :-1]
+    elif hash_type == 'phash':
+        dct = dct_matrix(PHASH_IMAGE_SIZE)
+        low_frequencies = (dct @ pixels @ dct.T)[:, :hash_size, :hash_size].reshape(len(pixels), -1)
+        # the DC coefficient is left out of the median, it only reflects the overall brightness
+        medians = np.median(low_frequencies[:, 1:], axis=1, keepdims=True)
+        bits = low_frequencies > medians
+    else:
+        raise ValueError(f"Unknown perceptual hash type '{hash_type}', expected one of {PERCEPTUAL_HASH_TYPES}")
+    packed = np.packbits(bits.reshape(len(pixels), -1), axis=1)
+    return [int.from_bytes(row.tobytes(), 'big') for row in packed]
+
+
+def hamming_distance(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count('1')
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over perceptual hashes with the Hamming distance. A query only descends into the children
+    whose distance to a node is within the threshold of the query's distance to that node (triangle inequality), so
+    near neighbours are found without comparing every pair of images.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, hash, item):
+        node = [hash, item, {}]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming_distance(hash, current[0])
+            if distance in current[2]:
+                current = current[2][distance]
+            else:
+                current[2][distance] = node
+                return
+
+    def query(self, hash, threshold):
+        """
+        Yield (item, distance) for every hash within threshold of hash
+        """
+        if self.root is None:
+            return
+        candidates = [self.root]
+        while candidates:
+            node_hash, item, children = candidates.pop()
+            distance = hamming_distance(hash, node_hash)
+            if distance <= threshold:
+                yield item, distance
+            for child_distance, child in children.items():
+                if distance - threshold <= child_distance <= distance + threshold:
+                    candidates.append(child)
+
+
+class DisjointSet:
+    """
+    Union-find over image indices, the root of a cluster is always the image that was seen first
+    """
+
+    def __init__(self):
+        self.parents = []
+
+    def add(self):
+        self.parents.append(len(self.parents))
+
+    def find(self, index):
+        while self.parents[index] != index:
+            self.parents[index] = self.parents[self.parents[index]]
+            index = self.parents[index]
+        return index
+
+    def union(self, index_a, index_b):
+        root_a, root_b = self.find(index_a), self.find(index_b)
+        if root_a != root_b:
+            self.parents[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def iter_image_batches(inputs, size, batch_size=HASH_BATCH_SIZE):
+    """
+    Yield (names, source archives, pixel array) batches of the decodable images in the inputs, in input order
+    """
+    names, sources, pixels = [], [], []
+    for zip_path in inputs:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            for entry in zip_ref.infolist():
+                if entry.is_dir():
+                    continue
+                try:
+                    with zip_ref.open(entry, 'r') as image_ifd:
+                        pixels.append(load_pixels(image_ifd, size))
+                except Exception as ex:
+                    logging.info("Couldn't read image file '%s' in %s: %s", entry.filename, zip_path, str(ex))
+                    continue
+                names.append(entry.filename)
+                sources.append(zip_path)
+                if len(pixels) == batch_size:
+                    yield names, sources, np.stack(pixels)
+                    names, sources, pixels = [], [], []
+    if pixels:
+        yield names, sources, np.stack(pixels)
+
+
+def find_near_duplicates(inputs, hash_type='phash', hash_size=8, threshold=8):
+    """
+    Hash every image in the inputs and cluster the images whose perceptual hashes are within threshold bits of each
+    other. Returns a DataFrame with one row per image that belongs to a cluster of two or more images.
+    """
+    size = hash_input_size(hash_type, hash_size)
+    tree = BKTree()
+    clusters = DisjointSet()
+    names, sources, hashes, distances = [], [], [], []
+    for batch_names, batch_sources, batch_pixels in iter_image_batches(inputs, size):
+        for name, source, hash in zip(batch_names, batch_sources, perceptual_hashes(batch_pixels, hash_type, hash_size)):
+            index = len(names)
+            clusters.add()
+            closest = None
+            for neighbour, distance in tree.query(hash, threshold):
+                clusters.union(index, neighbour)
+                closest = distance if closest is None else min(closest, distance)
+            tree.add(hash, index)
+            names.append(name)
+            sources.append(source)
+            hashes.append(hash)
+            distances.append(closest)
+
+    hex_width = (hash_size * hash_size + 3) // 4
+    df = pd.DataFrame({'cluster_id': [clusters.find(index) for index in range(len(names))],
+                       'image_name': names,
+                       'source_archive': sources,
+                       'hash_type': hash_type,
+                       'perceptual_hash': [format(hash, f'0{hex_width}x') for hash in hashes],
+                       'nearest_distance': distances})
+    df = df[df.groupby('cluster_id')['cluster_id'].transform('size') > 1].copy()
+    # number the clusters in the order their first image was seen
+    df['cluster_id'] = pd.factorize(df['cluster_id'])[0]
+    df['is_representative'] = ~df['cluster_id'].duplicated()
+    return df
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    print("Python version:", sys.version)
+    parser = argparse.ArgumentParser(description="Find near-duplicate images (e.g. the same chart re-saved at another "
+                                                 "JPEG quality or resolution) with perceptual hashes")
+    parser.add_argument("--inputs", dest="inputs", nargs="+", help="Zip archives of images, e.g. the unique images "
+                                                                   "output of dedup_images.py", required=True)
+    parser.add_argument("--config_file",
+                        dest="config_file_loc",
+                        help="The dedup_images.py config file, the clusters CSV is written next to the unique and "
+                             "duplicate image CSVs. Include the file name in the path.")
+    parser.add_argument("--output", dest="output", help="Clusters CSV to write, overrides the config file")
+    parser.add_argument("--hash_type", dest="hash_type", choices=PERCEPTUAL_HASH_TYPES, default="phash")
+    parser.add_argument("--hash_size", dest="hash_size", type=int, default=8,
+                        help="Side of the hash grid, the hashes are hash_size * hash_size bits. Default is 8.")
+    parser.add_argument("--threshold", dest="threshold", type=int, default=8,
+                        help="Maximum Hamming distance between the hashes of two near-duplicates. Default is 8.")
+    args = parser.parse_args()
+    if args.hash_type == 'phash' and args.hash_size > PHASH_IMAGE_SIZE:
+        parser.error(f"--hash_size can be at most {PHASH_IMAGE_SIZE} for phash")
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.output:
+        CLUSTERS_CSV_FULL_PATH = args.output
+    else:
+        config = load_config(args.config_file_loc or os.path.join('..', 'config', 'dedup_config.yaml'))
+        CLUSTERS_CSV_FULL_PATH = os.path.join(config['data_output']['output_image_csv_dir'],
+                                              config['data_output'].get('near_duplicate_csv_filename',
+                                                                        'near_duplicate_clusters.csv'))
+
+    logging.info("Starting %s computing: %s", args.hash_type, format_duration(time.time() - start_time))
+    clusters_df = find_near_duplicates(args.inputs, args.hash_type, args.hash_size, args.threshold)
+    logging.info("Found %d near-duplicate clusters with %d images: %s", clusters_df['cluster_id'].nunique(),
+                 len(clusters_df), format_duration(time.time() - start_time))
+
+    clusters_df.to_csv(CLUSTERS_CSV_FULL_PATH, index=False, header=True, encoding='utf-8', sep=',')
+    logging.info("Saved near-duplicate clusters here: %s", CLUSTERS_CSV_FULL_PATH)
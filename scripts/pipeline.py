@@ -0,0 +1,230 @@
+import argparse
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+import zlib
+from pathlib import Path
+
+import metrics
+from dedup_images import (IMAGE_COLUMNS, ImageRecords, add_to_hash_store, format_duration, init_file_structure,
+                          load_config, open_existing_hashes, output_paths, write_image_csvs)
+from digests import DEFAULT_HASH_ALGO, available_hash_algos, new_hasher
+from filter_files import add_threshold_arguments, measure_image, passes_name_checks
+from measurement_cache import MEASUREMENT_COLUMNS
+from process_files import DEFAULT_SPOOL_MAX_SIZE, process_file, top_level_files
+from zip_writer import COMPRESSION_POLICIES, ShardedZipWriter
+
+
+def filtered_name(name):
+    """
+    Name an extracted image has in the output of filter_files.py, which is the original_file_name of dedup_images.py
+    """
+    return name.lstrip("/").replace("/", "_")
+
+
+class FilterDedupSink:
+    """
+    Sink for process_file() that runs every extracted image through the checks of filter_files.py and the hash
+    deduplication of dedup_images.py in memory, so that only the unique images that pass the filter are written, once.
+    The image tables are the ones dedup_images.py builds from the output of filter_files.py.
+    """
+
+    def __init__(self, args, existing_hashes, unique_writer, duplicate_writer=None):
+        self.args = args
+        self.existing_hashes = existing_hashes
+        self.unique_writer = unique_writer
+        self.duplicate_writer = duplicate_writer
+        columns = IMAGE_COLUMNS + (['is_duplicate_with_existing'] if existing_hashes else [])
+        self.processed = ImageRecords(columns)
+        self.unique = ImageRecords(columns)
+        self.duplicates = ImageRecords(columns)
+        self.seen_hashes = set()
+        # identical images get the same verdict on their content, so the measurements are kept by hash and each
+        # distinct image is decoded once
+        self.measurements = {}
+        # the top-level file the images come from
+        self.source_archive = None
+        self.extracted_cnt = 0
+        self.filtered_cnt = 0
+        self.error_cnt = 0
+
+    def _passes_filter(self, name, data, hash):
+        if not passes_name_checks(name, len(data), self.args):
+            return False
+        try:
+            with metrics.timer("decode"):
+                accepted, self.measurements[hash] = measure_image(lambda: io.BytesIO(data), self.args,
+                                                                  self.measurements.get(hash))
+        except Exception as ex:
+            logging.info("Couldn't read image file '%s', error: %s", name, str(ex))
+            # remembered as unreadable, so that copies of the image are not decoded again
+            self.measurements[hash] = dict.fromkeys(MEASUREMENT_COLUMNS)
+            accepted = False
+        return accepted
+
+    def _write(self, writer, arcname, data, zip_source):
+        try:
+            with metrics.timer("write"):
+                if zip_source is not None and writer.can_copy_raw(arcname, zip_source[1]):
+                    # the bytes are unchanged, so the compressed member is copied as is
+                    writer.write_raw(arcname, *zip_source)
+                else:
+                    writer.writestr(arcname, data)
+            metrics.add("images_written")
+            metrics.add("bytes_out", len(data))
+        except Exception as ex:
+            logging.info("Unable to write %s to %s, error: %s", arcname, writer.path, str(ex))
+            self.error_cnt = self.error_cnt + 1
+
+    def add(self, name, fhandle, index, zip_source=None):
+        self.extracted_cnt += 1
+        data = fhandle.read()
+        with metrics.timer("hash"):
+            hasher = new_hasher(self.args.hash_algo)
+            hasher.update(data)
+            hash = hasher.hexdigest()
+        if not self._passes_filter(name, data, hash):
+            logging.debug("Filtered out image '%s'", name)
+            self.filtered_cnt += 1
+            return
+        metrics.add("images_kept")
+
+        original_file_name = filtered_name(name)
+        image_id = str(uuid.uuid4())
+        ext = Path(original_file_name).suffix
+        record = [original_file_name, image_id, ext, hash, self.source_archive, len(data), zlib.crc32(data)]
+        is_duplicate_with_existing = hash in self.existing_hashes
+        if self.existing_hashes:
+            record.append(is_duplicate_with_existing)
+
+        self.processed.append(*record)
+        if is_duplicate_with_existing or hash in self.seen_hashes:
+            self.duplicates.append(*record)
+            if self.duplicate_writer is not None:
+                self._write(self.duplicate_writer, image_id + ext, data, zip_source)
+        else:
+            self.seen_hashes.add(hash)
+            self.unique.append(*record)
+            self._write(self.unique_writer, image_id + ext, data, zip_source)
+        logging.debug("Image '%s' is image_id %s", original_file_name, image_id)
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    print("Python version:", sys.version)
+    parser = argparse.ArgumentParser(
+        description="Extract, filter and deduplicate images in a single pass. Gives the output zips and CSVs of "
+                    "dedup_images.py run on the output of filter_files.py run on the output of process_files.py, "
+                    "without writing the intermediate archives.")
+    parser.add_argument("inputs", nargs="*",
+                        help="Any number and mixture of Powerpoint and Excel files, and zip/tar files of them. If "
+                             "specifying --input_dir TRUE, then these are directories.")
+    parser.add_argument("--input_dir", dest="input_dir", default="FALSE", choices=["TRUE", "FALSE", "true", "false"],
+                        help="Whether the inputs are directories to process all files under")
+    parser.add_argument("--config_file",
+                        dest="config_file_loc",
+                        default=os.path.join('..', 'config', 'dedup_config.yaml'),
+                        help="Location of the deduplication config file, which names the output zips, CSVs and log "
+                             "file. Include the file name in the path.")
+    parser.add_argument("--output_type",
+                        dest="output_type",
+                        default="unique",
+                        help="'unique': Only save the unique files or `all`: Saves both unique files and the duplicate "
+                             "files. Default is unique.")
+    parser.add_argument("--image_extensions", dest="image_extensions", nargs="*", default=[".jpg", ".jpeg", ".png"])
+    parser.add_argument("--zip_extensions", dest="zip_extensions", nargs="*", default=[".zip", ".xlsx", ".pptx"])
+    parser.add_argument("--old_extensions", dest="old_extensions", nargs="*", default=[".ppt", ".xls"])
+    parser.add_argument("--tar_extensions", dest="tar_extensions", nargs="*",
+                        default=[".tar", ".tgz", ".tbz2", ".tar.bz2", ".tar.gz"])
+    parser.add_argument("--spool_max_size", dest="spool_max_size", default=DEFAULT_SPOOL_MAX_SIZE, type=int,
+                        help="Nested archives up to this many bytes are held in memory, larger ones are copied to a "
+                             "temporary file")
+    add_threshold_arguments(parser)
+    parser.add_argument("--existing_hashes",
+                        dest="existing_hashes",
+                        help="Hashes from previous deduplication runs to compare against, as for dedup_images.py")
+    parser.add_argument("--hash_algo",
+                        dest="hash_algo",
+                        choices=available_hash_algos(),
+                        default=DEFAULT_HASH_ALGO,
+                        help="Hash algorithm used to find duplicates, as for dedup_images.py")
+    parser.add_argument("--compression", dest="compression", choices=COMPRESSION_POLICIES, default="auto",
+                        help="Compression of the output zip files, as for dedup_images.py")
+    parser.add_argument("--shard_max_members", dest="shard_max_members", type=int,
+                        help="Roll the output zip files over to a new numbered shard after this many images")
+    parser.add_argument("--shard_max_bytes", dest="shard_max_bytes", type=int,
+                        help="Roll the output zip files over to a new numbered shard after this many (compressed) "
+                             "bytes")
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    config = load_config(args.config_file_loc)
+    paths = output_paths(config)
+    init_file_structure(config)
+
+    file_handler = logging.FileHandler(paths['log_file'])
+    file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logging.getLogger('').addHandler(file_handler)
+    logging.info("Application Logging Initialized")
+
+    existing_hashes, hash_store = open_existing_hashes(args.existing_hashes, args.hash_algo)
+
+    temp_path = tempfile.mkdtemp()
+    duplicate_writer = None
+    try:
+        with metrics.instrumented(args, "pipeline"), \
+                ShardedZipWriter(paths['unique_zip'], compression=args.compression, max_members=args.shard_max_members,
+                                 max_bytes=args.shard_max_bytes) as unique_writer:
+            if args.output_type.lower() == 'all':
+                duplicate_writer = ShardedZipWriter(paths['duplicate_zip'], compression=args.compression,
+                                                    max_members=args.shard_max_members,
+                                                    max_bytes=args.shard_max_bytes)
+            sink = FilterDedupSink(args, existing_hashes, unique_writer, duplicate_writer)
+            current_index = 0
+            for fname in top_level_files(args.inputs, args.input_dir):
+                logging.info("Processing top-level file '%s'", fname)
+                sink.source_archive = fname
+                with open(fname, "rb") as ifd:
+                    current_index = process_file(
+                        sink,
+                        current_index,
+                        fname,
+                        fhandle=ifd,
+                        temp_path=temp_path,
+                        image_exts=args.image_extensions,
+                        zip_exts=args.zip_extensions,
+                        old_exts=args.old_extensions,
+                        tar_exts=args.tar_extensions,
+                        spool_max_size=args.spool_max_size
+                    )
+    finally:
+        if duplicate_writer is not None:
+            duplicate_writer.close()
+        shutil.rmtree(temp_path)
+
+    image_df = sink.processed.to_dataframe()
+    image_unique_df = sink.unique.to_dataframe()
+    image_dup_df = sink.duplicates.to_dataframe()
+    write_image_csvs(paths, image_df, image_unique_df, image_dup_df, args.hash_algo)
+
+    if hash_store is not None:
+        added_cnt = add_to_hash_store(hash_store, image_unique_df)
+        logging.info("Added %d new unique hashes to hash store %s", added_cnt, args.existing_hashes)
+        hash_store.close()
+
+    logging.info("Total images extracted: %s", sink.extracted_cnt)
+    logging.info("Total images filtered out: %s", sink.filtered_cnt)
+    logging.info("Total images processed: %s", len(image_df))
+    logging.info("Total unique images: %s", len(image_unique_df))
+    logging.info("Total duplicates found: %s", len(image_dup_df))
+    logging.info("Total errors: %s", sink.error_cnt)
+    if unique_writer.paths:
+        logging.info("Wrote %s unique images to: %s", len(image_unique_df), ', '.join(unique_writer.paths))
+    logging.info("Total pipeline run time: " + format_duration(time.time() - start_time))
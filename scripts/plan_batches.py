@@ -0,0 +1,262 @@
+import argparse
+import csv
+import heapq
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import tempfile
+import time
+import zipfile
+from collections import defaultdict
+
+from file_types import file_extension
+from process_files import (DEFAULT_SPOOL_MAX_SIZE, ZipImageSink, format_duration, process_file, read_input_list,
+                           top_level_files)
+
+# Columns of the batch manifest, one row per batch, so that row N is the task of SLURM array index N
+BATCH_COLUMNS = ['batch', 'output', 'input_list', 'files', 'bytes', 'estimated_seconds']
+
+# Name of the batch manifest in the plan directory
+BATCHES_FILE = "batches.csv"
+
+
+def file_type(fname):
+    """
+    The file type a cost model is kept by, which is the lower case extension (e.g. '.pptx' or '.tar.gz')
+    """
+    return file_extension(os.path.basename(fname)) or ''
+
+
+def load_cost_model(path):
+    """
+    Read a cost model written by --measure_cost_model: the measured bytes per second of every file type, the bytes per
+    second over all types for the types that were not measured, and a fixed number of seconds per file
+    """
+    with open(path) as ifd:
+        cost_model = json.load(ifd)
+    cost_model.setdefault('seconds_per_file', 0.0)
+    return cost_model
+
+
+def estimate_seconds(fname, size, cost_model):
+    bytes_per_second = cost_model['bytes_per_second'].get(file_type(fname), cost_model['default_bytes_per_second'])
+    return cost_model['seconds_per_file'] + size / bytes_per_second
+
+
+def file_costs(fnames, cost_model=None, skip_missing=False):
+    """
+    Returns (file name, size, cost) of every input, in input order. The cost is the estimated seconds with a cost
+    model and the size on disk otherwise. A file that cannot be found raises OSError, or with skip_missing is left out
+    with a warning.
+    """
+    costs = []
+    for fname in fnames:
+        try:
+            size = os.path.getsize(fname)
+        except OSError as ex:
+            if not skip_missing:
+                raise
+            logging.warning("Leaving out '%s', error: %s", fname, str(ex))
+            continue
+        costs.append((fname, size, estimate_seconds(fname, size, cost_model) if cost_model else size))
+    return costs
+
+
+def batch_count(costs, max_batch_cost):
+    """
+    The number of batches that keeps the batches around max_batch_cost. A file costing more than that gets a batch of
+    its own.
+    """
+    return max(1, math.ceil(sum(cost for _, _, cost in costs) / max_batch_cost))
+
+
+def plan_batches(costs, num_batches):
+    """
+    Divide the files between num_batches batches of about equal cost: the files are taken from the most to the least
+    costly and each goes to the batch with the lowest cost so far, which puts the few very large files in batches of
+    their own and fills the others up with the many small ones. Of batches with the same cost, the one with the fewest
+    files is filled first, so that there are num_batches batches if there are that many files. Returns the batches as
+    lists of indices into costs, each in input order, leaving out empty batches.
+    """
+    heap = [(0, 0, batch) for batch in range(num_batches)]
+    batches = [[] for _ in range(num_batches)]
+    for position in sorted(range(len(costs)), key=lambda position: costs[position][2], reverse=True):
+        load, files, batch = heapq.heappop(heap)
+        batches[batch].append(position)
+        heapq.heappush(heap, (load + costs[position][2], files + 1, batch))
+    return [sorted(batch) for batch in batches if batch]
+
+
+def _write_if_changed(path, text):
+    # a batch list that did not change keeps its time stamp, so that SCons does not run the batch again
+    if os.path.exists(path):
+        with open(path) as ifd:
+            if ifd.read() == text:
+                return
+    with open(path, "w") as ofd:
+        ofd.write(text)
+
+
+def write_plan(plan_dir, costs, batches, output_dir, prefix, cost_model=None):
+    """
+    Write the input list of every batch and the batch manifest to plan_dir. Batch N reads plan_dir/PREFIX_N.txt and
+    writes output_dir/PREFIX_N.zip. Returns the rows of the manifest.
+    """
+    os.makedirs(plan_dir, exist_ok=True)
+    rows = []
+    for batch, positions in enumerate(batches):
+        input_list = os.path.join(plan_dir, f"{prefix}_{batch}.txt")
+        _write_if_changed(input_list, "".join(costs[position][0] + "\n" for position in positions))
+        rows.append({
+            'batch': batch,
+            'output': os.path.join(output_dir, f"{prefix}_{batch}.zip"),
+            'input_list': input_list,
+            'files': len(positions),
+            'bytes': sum(costs[position][1] for position in positions),
+            'estimated_seconds': round(sum(costs[position][2] for position in positions), 2) if cost_model else '',
+        })
+    with open(os.path.join(plan_dir, BATCHES_FILE), "w", newline="") as manifest_ofd:
+        manifest_writer = csv.DictWriter(manifest_ofd, fieldnames=BATCH_COLUMNS)
+        manifest_writer.writeheader()
+        manifest_writer.writerows(rows)
+    return rows
+
+
+def measure_cost_model(fnames, sample_size, temp_path, args, seed=0):
+    """
+    Extract up to sample_size files of every file type, as process_files.py does, and return a cost model of the
+    bytes per second each type is extracted at
+    """
+    by_type = defaultdict(list)
+    for fname in fnames:
+        by_type[file_type(fname)].append(fname)
+    rng = random.Random(seed)
+    measured = {}
+    total_bytes, total_seconds = 0, 0.0
+    for ext, type_fnames in sorted(by_type.items()):
+        type_bytes, type_seconds = 0, 0.0
+        for fname in rng.sample(type_fnames, min(sample_size, len(type_fnames))):
+            output_path = os.path.join(temp_path, "sample.zip")
+            start_time = time.perf_counter()
+            with zipfile.ZipFile(output_path, "w") as ofd, open(fname, "rb") as ifd:
+                process_file(
+                    ZipImageSink(ofd),
+                    0,
+                    fname,
+                    fhandle=ifd,
+                    temp_path=temp_path,
+                    image_exts=args.image_extensions,
+                    zip_exts=args.zip_extensions,
+                    old_exts=args.old_extensions,
+                    tar_exts=args.tar_extensions,
+                    spool_max_size=args.spool_max_size
+                )
+            type_seconds += time.perf_counter() - start_time
+            type_bytes += os.path.getsize(fname)
+            os.remove(output_path)
+        if type_seconds and type_bytes:
+            measured[ext] = round(type_bytes / type_seconds)
+            logging.info("Measured %s: %.1f MB/s", ext or "files without extension", measured[ext] / 1e6)
+        total_bytes += type_bytes
+        total_seconds += type_seconds
+    return {
+        'bytes_per_second': measured,
+        'default_bytes_per_second': round(total_bytes / total_seconds) if total_seconds and total_bytes else 1e7,
+        'seconds_per_file': 0.0,
+    }
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    parser = argparse.ArgumentParser(
+        description="Divide the inputs of process_files.py into batches of about equal cost, by their size on disk or "
+                    "by the time a cost model estimates for them. Writes the input list of every batch and a manifest "
+                    "of the batches, one per row, for run_batches.py (locally or as a SLURM array) or SCons.")
+    parser.add_argument("inputs", nargs="*",
+                        help="Any number and mixture of Powerpoint and Excel files, and zip/tar files of them. If "
+                             "specifying --input_dir TRUE, then these are directories.")
+    parser.add_argument("--input_dir", dest="input_dir", default="FALSE", choices=["TRUE", "FALSE", "true", "false"],
+                        help="Whether the inputs are directories to process all files under")
+    parser.add_argument("--input_list", dest="input_list",
+                        help="Text file naming an input file on every line, added to the inputs")
+    parser.add_argument("--skip_missing", dest="skip_missing", default=False, action="store_true",
+                        help="Leave out inputs that cannot be found with a warning, instead of stopping")
+    parser.add_argument("--plan_dir", dest="plan_dir", default="work",
+                        help="Directory to write the batch input lists and the manifest (batches.csv) to")
+    parser.add_argument("--output_dir", dest="output_dir", default="work",
+                        help="Directory the batches write their output archives to")
+    parser.add_argument("--prefix", dest="prefix", default="batch",
+                        help="Prefix of the names of the batch input lists and output archives")
+    parser.add_argument("--batches", dest="batches", type=int, help="Number of batches")
+    parser.add_argument("--batch_bytes", dest="batch_bytes", type=int,
+                        help="Make as many batches as it takes for about this many input bytes each")
+    parser.add_argument("--batch_seconds", dest="batch_seconds", type=float,
+                        help="Make as many batches as it takes for about this many estimated seconds each, which "
+                             "needs --cost_model")
+    parser.add_argument("--cost_model", dest="cost_model",
+                        help="Cost model written by --measure_cost_model. The batches are then balanced by the "
+                             "estimated extraction time of their files instead of by their size.")
+    parser.add_argument("--measure_cost_model", dest="measure_cost_model",
+                        help="Instead of planning batches, extract a sample of the inputs of every file type and write "
+                             "the bytes per second measured for each type to this JSON file")
+    parser.add_argument("--sample_size", dest="sample_size", type=int, default=20,
+                        help="Files of every type extracted by --measure_cost_model")
+    parser.add_argument("--seed", dest="seed", type=int, default=0)
+    parser.add_argument("--image_extensions", dest="image_extensions", nargs="*", default=[".jpg", ".jpeg", ".png"])
+    parser.add_argument("--zip_extensions", dest="zip_extensions", nargs="*", default=[".zip", ".xlsx", ".pptx"])
+    parser.add_argument("--old_extensions", dest="old_extensions", nargs="*", default=[".ppt", ".xls"])
+    parser.add_argument("--tar_extensions", dest="tar_extensions", nargs="*",
+                        default=[".tar", ".tgz", ".tbz2", ".tar.bz2", ".tar.gz"])
+    parser.add_argument("--spool_max_size", dest="spool_max_size", default=DEFAULT_SPOOL_MAX_SIZE, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    fnames = list(top_level_files(args.inputs, args.input_dir))
+    if args.input_list:
+        fnames.extend(read_input_list(args.input_list))
+    if not fnames:
+        parser.error("No inputs given")
+
+    if args.measure_cost_model:
+        temp_path = tempfile.mkdtemp()
+        try:
+            cost_model = measure_cost_model(fnames, args.sample_size, temp_path, args, args.seed)
+        finally:
+            shutil.rmtree(temp_path)
+        with open(args.measure_cost_model, "w") as ofd:
+            json.dump(cost_model, ofd, indent=2)
+        logging.info("Wrote the cost model to %s in %s", args.measure_cost_model,
+                     format_duration(time.time() - start_time))
+    else:
+        if sum(option is not None for option in (args.batches, args.batch_bytes, args.batch_seconds)) != 1:
+            parser.error("Give one of --batches, --batch_bytes and --batch_seconds")
+        if args.batch_seconds and not args.cost_model:
+            parser.error("--batch_seconds requires --cost_model")
+        cost_model = load_cost_model(args.cost_model) if args.cost_model else None
+        try:
+            costs = file_costs(fnames, cost_model, args.skip_missing)
+        except OSError as ex:
+            parser.error(f"{ex}. Give --skip_missing to leave out the inputs that cannot be found.")
+        if not costs:
+            parser.error("None of the inputs could be found, there is nothing to plan")
+        if args.batches:
+            num_batches = args.batches
+        elif args.batch_seconds and cost_model:
+            num_batches = batch_count(costs, args.batch_seconds)
+        elif cost_model:
+            # the byte limit sets the number of batches, which are then balanced by their estimated time
+            num_batches = batch_count([(fname, size, size) for fname, size, _ in costs], args.batch_bytes)
+        else:
+            num_batches = batch_count(costs, args.batch_bytes)
+        rows = write_plan(args.plan_dir, costs, plan_batches(costs, num_batches), args.output_dir, args.prefix,
+                          cost_model)
+        largest = max(rows, key=lambda row: row['estimated_seconds'] if cost_model else row['bytes'])
+        logging.info("Planned %d batches of %d files (%.1f GB), the largest is batch %d with %d files (%.1f GB%s)",
+                     len(rows), len(costs), sum(size for _, size, _ in costs) / 1e9, largest['batch'],
+                     largest['files'], largest['bytes'] / 1e9,
+                     f", about {format_duration(largest['estimated_seconds'])}" if cost_model else "")
+        logging.info("Wrote the batch manifest to %s", os.path.join(args.plan_dir, BATCHES_FILE))
@@ -1,20 +1,42 @@
 from datetime import datetime
-import subprocess
-import re
+import io
 import sys
 import os.path
 import os
 import argparse
-import shlex
+import csv
+import itertools
+import json
+import queue
+import threading
 import time
-from glob import glob
+from collections import deque
+from contextlib import contextmanager
 import logging
+import multiprocessing
 import zipfile
 import tarfile
 import tempfile
 import shutil
+try:
+    import resource
+except ImportError:
+    # not available on Windows, the peak memory use is then not reported
+    resource = None
 import yaml
+from hachoir.core import config as hachoir_config
+from hachoir.core.memory import limitedMemory
+from hachoir.stream import InputIOStream
+from hachoir.subfile.search import FILE_MAX_SIZE, MEMORY_LIMIT, SearchSubfile
+import metrics
+from digests import DEFAULT_HASH_ALGO, available_hash_algos, hash_fileobj
+from file_types import (CFB, COMPRESSED, IMAGE, IMAGE_FORMAT_EXTENSIONS, TAR, ZIP, file_extension, image_formats,
+                        peek_header, sniff)
 from solr_search import SolrSearch
+from zip_writer import COPY_CHUNK_SIZE, copy_raw_member, raw_copy_supported, reopen_for_append
+
+# hachoir warns on the console about every malformed structure it comes across in the old formats
+hachoir_config.quiet = True
 
 
 def load_config(config_path):
@@ -51,14 +73,62 @@ def get_config_value(config_dict, *keys, default=None):
     return current
 
 
-def build_partial_load_inputs(partial_load, root_dir):
-    full_path_ids = []
-    for file_id in partial_load:
-        leading_letters = ''.join([char for char in file_id if char.isalpha()])
-        # id_part = file_id[len(leading_letters):]
-        id_path = os.path.join(root_dir, *leading_letters, file_id)
-        full_path_ids.append(id_path)
-    return full_path_ids
+# Paths of partial load ids resolved ahead of the extraction while
+# Solr pages are still arriving.
+DEFAULT_PARTIAL_LOAD_QUEUE_DEPTH = 1000
+
+# Seconds cached Solr results are used for, before the query is run against the server again
+DEFAULT_SOLR_CACHE_MAX_AGE = 24 * 60 * 60
+
+
+def partial_load_path(file_id, root_dir):
+    leading_letters = ''.join([char for char in file_id if char.isalpha()])
+    # id_part = file_id[len(leading_letters):]
+    return os.path.join(root_dir, *leading_letters, file_id)
+
+
+def stream_partial_load_inputs(file_ids, root_dir, queue_depth=DEFAULT_PARTIAL_LOAD_QUEUE_DEPTH):
+    """
+    Yield the paths of the ids from a (slow) id generator such as SolrSearch.iter_ids, so that extraction starts on the
+    first page of results. A producer thread requests the ids and resolves their paths ahead of the extraction, at most
+    queue_depth of them, which bounds the memory used however many ids the query returns.
+    """
+    paths = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # gives up once the consumer has stopped, instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                paths.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for file_id in file_ids:
+                if not put(partial_load_path(file_id, root_dir)):
+                    return
+        except Exception as e:
+            put(e)
+        else:
+            put(done)
+
+    producer = threading.Thread(target=produce, name="partial-load-ids", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = paths.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
 
 
 def create_file_name_with_timestamp(file_name_path):
@@ -69,14 +139,254 @@ def create_file_name_with_timestamp(file_name_path):
     new_file_name = f"{file_name}_{timestamp}{file_ext}"
     return os.path.join(dir_name, new_file_name)
 
+class ImageSearch(SearchSubfile):
+    """
+    Hachoir's subfile search, collecting the (offset, size) in bits of every image it finds instead of printing them
+    and writing them out
+    """
+
+    def __init__(self, stream):
+        super().__init__(stream)
+        self.verbose = False
+        self.found = []
+        self.loadParsers(categories=["image"])
+        # set up by SearchSubfile.mainHeader(), which also prints a banner on the console
+        self.slice_size = max(self.slice_size, self.patterns.max_length * 8)
+        self.stats = {}
+
+    def processParser(self, offset, parser):
+        self.found.append((offset, parser.content_size, parser.filename_suffix))
+
+
+def iter_embedded_images(fhandle):
+    """
+    Search a file in one of the old binary formats for embedded images with the Hachoir library, in this process and
+    without writing anything to disk. Yields (file name, offset, size) in bytes for every image found, in the order of
+    their offsets. The names are the ones the hachoir-subfile command gives the files it extracts (file-0001.jpg, ...).
+    """
+    search = ImageSearch(InputIOStream(fhandle, source="legacy file"))
+    # under the same memory limit as SearchSubfile.main(), a MemoryError is logged by the caller
+    limitedMemory(MEMORY_LIMIT, search.searchSubfiles)
+    file_id = 0
+    for offset, size, suffix in search.found:
+        # the same images hachoir-subfile writes out: with a known size, not the whole file, and not too big
+        if not size or (offset == 0 and size == search.size) or size // 8 >= FILE_MAX_SIZE:
+            continue
+        file_id += 1
+        yield "file-%04u%s" % (file_id, suffix or ""), offset // 8, size // 8
+
+
+# Nested archives up to this size are held in memory while they are
+# processed, larger ones are spilled to a temporary file.
+DEFAULT_SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+
+@contextmanager
+def seekable_copy(fhandle, temp_path=None, spool_max_size=DEFAULT_SPOOL_MAX_SIZE):
+    """
+    A file object for a nested archive that seeks cheaply. Members of zip and tar archives can seek, but a backwards
+    seek in a compressed member decompresses it again from the start, so they are copied to a temporary file first.
+    The copy stays in memory up to spool_max_size bytes and is moved to a file in temp_path beyond that, so a large
+    nested deck is never held in memory whole. Files on disk and in-memory data are used as they are.
+    """
+    if isinstance(fhandle, io.BytesIO):
+        yield fhandle
+        return
+    try:
+        fhandle.fileno()
+    except (AttributeError, OSError):
+        pass
+    else:
+        yield fhandle
+        return
+    with tempfile.SpooledTemporaryFile(max_size=spool_max_size, dir=temp_path) as spool:
+        with metrics.timer("spool"):
+            shutil.copyfileobj(fhandle, spool, COPY_CHUNK_SIZE)
+        metrics.add("bytes_spooled", spool.tell())
+        spool.seek(0)
+        yield spool
+
+
+def peak_memory_mb(children=False):
+    """
+    Peak resident memory of this process in MB, or with children that of the largest of its finished worker processes
+    (the peaks of different processes are not added up, as they need not have been at the same time). None where
+    unknown.
+    """
+    if resource is None:
+        return None
+    # kilobytes on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+# Columns of the inline dedup CSV, one row per extracted image
+INLINE_DEDUP_COLUMNS = ["image_name", "image_index", "hash", "hash_algo", "stored_as"]
+
+# Columns of the extraction manifest, one row per image
+MANIFEST_COLUMNS = ["top_level_file", "nested_path", "image_index"]
+
+# Top-level documents handed to the worker processes ahead of the one
+# being merged, per worker.  Bounds the disk used by document shards
+# waiting behind a slow document.
+PENDING_DOCUMENTS_PER_WORKER = 4
+
+
+class ZipImageSink:
+    """
+    Writes the extracted images into an output zip archive
+    """
+
+    def __init__(self, ofd):
+        self.ofd = ofd
+
+    def _write(self, name, fhandle, zip_source=None):
+        # returns the uncompressed size of the image
+        with metrics.timer("write"):
+            if zip_source is not None and raw_copy_supported(zip_source[1]):
+                # an image from a zip archive (or pptx/xlsx) is copied without inflating and deflating it again
+                return copy_raw_member(*zip_source, self.ofd, name).file_size
+            data = fhandle.read()
+            with self.ofd.open(name, "w") as image_ofd:
+                image_ofd.write(data)
+            return len(data)
+
+    def add(self, name, fhandle, index, zip_source=None):
+        file_size = self._write(name, fhandle, zip_source)
+        metrics.add("images_written")
+        metrics.add("bytes_out", file_size)
+
+
+class DedupImageSink(ZipImageSink):
+    """
+    Writes each distinct image content into the output archive only once. Every image, repeated or not, is recorded in
+    the inline dedup CSV together with the name its content is stored under.
+    """
+
+    def __init__(self, ofd, dedup_csv):
+        super().__init__(ofd)
+        self.dedup_csv = dedup_csv
+
+    def add(self, name, fhandle, index, zip_source=None):
+        with metrics.timer("hash"):
+            digest = hash_fileobj(fhandle, self.dedup_csv.hash_algo, COPY_CHUNK_SIZE)
+        if self.dedup_csv.record(name, index, digest):
+            fhandle.seek(0)
+            super().add(name, fhandle, index, zip_source)
+
+
+class ShardImageSink(ZipImageSink):
+    """
+    Writes the images of one top-level document into its own shard archive and remembers the index of each of them
+    within the document, and their hashes if hash_algo is given
+    """
+
+    def __init__(self, ofd, hash_algo=None):
+        super().__init__(ofd)
+        self.hash_algo = hash_algo
+        self.indices = []
+        self.hashes = []
+
+    def add(self, name, fhandle, index, zip_source=None):
+        if self.hash_algo:
+            with metrics.timer("hash"):
+                self.hashes.append(hash_fileobj(fhandle, self.hash_algo, COPY_CHUNK_SIZE))
+            fhandle.seek(0)
+        # not counted as written, the merge counts the images that make it into the output
+        self._write(name, fhandle, zip_source)
+        self.indices.append(index)
+
+
+class InlineDedupCsv:
+    """
+    Sidecar CSV of the inline deduplication: one row per extracted image with the hash of its content and the name the
+    content is stored under in the output archive, so every FILE_NAME/IMAGE_NAME keeps its provenance while repeated
+    content is only written once
+    """
+
+    def __init__(self, path, hash_algo=DEFAULT_HASH_ALGO, resume_index=None):
+        self.path = path
+        self.hash_algo = hash_algo
+        self.stored_names = {}
+        self.duplicates = 0
+        rows = []
+        if resume_index is not None and os.path.exists(path):
+            # a resumed run keeps the rows of the images that are still in the output archive
+            with open(path, newline="") as ifd:
+                rows = [row for row in csv.DictReader(ifd) if int(row["image_index"]) <= resume_index]
+        self._ofd = open(path, "w", newline="")
+        self._writer = csv.writer(self._ofd)
+        self._writer.writerow(INLINE_DEDUP_COLUMNS)
+        for row in rows:
+            self.stored_names.setdefault(row["hash"], row["stored_as"])
+            self._writer.writerow([row[column] for column in INLINE_DEDUP_COLUMNS])
+
+    def record(self, name, index, hash):
+        """
+        Record an image, returns whether its content is new and has to be written
+        """
+        is_new = hash not in self.stored_names
+        if is_new:
+            self.stored_names[hash] = name
+        else:
+            self.duplicates += 1
+        self._writer.writerow([name, index, hash, self.hash_algo, self.stored_names[hash]])
+        return is_new
+
+    def close(self):
+        self._ofd.close()
+
+
+def classify(fhandle, ext, image_exts, zip_exts, tar_exts, old_exts):
+    """
+    Decide how process_file handles a file from its first bytes, read once. Returns (kind, image format), or
+    (None, None) for files to skip. Recognised content decides, so images with a wrong or missing extension are
+    extracted as long as their format is one of the image extensions. Containers are only opened if they have one of
+    the container extensions or no extension, e.g. a .docx is still skipped unless it is added to --zip_extensions.
+    Content that is not recognised falls back to the extension.
+    """
+    if fhandle is None:
+        # directories and links in tar archives
+        return None, None
+    kind, content_format = sniff(peek_header(fhandle))
+    if kind == IMAGE:
+        return (kind, content_format) if content_format in image_formats(image_exts) else (None, None)
+    if kind in (ZIP, CFB, COMPRESSED):
+        return (kind, content_format) if ext is None or ext in zip_exts + old_exts + tar_exts else (None, None)
+    if kind == TAR:
+        # tar archives are opened whatever their extension, as they were with tarfile.is_tarfile
+        return kind, content_format
+    if kind is not None:
+        return None, None
+    for kind, exts in [(ZIP, zip_exts), (CFB, old_exts), (IMAGE, image_exts), (TAR, tar_exts)]:
+        if ext in exts:
+            return kind, None
+    return None, None
+
+
+class CountingSink:
+    """
+    Records the name and index of every image instead of writing it. The images are only read as far as classify()
+    sniffs them.
+    """
+
+    def __init__(self):
+        self.images = []
+
+    def add(self, name, fhandle, index, zip_source=None):
+        self.images.append((name, index))
+
+
 # Extracts images, recursing into zip/tar archives as needed,
 # keeping a counter and only writing to output file if between
 # the minimum and maximum specified indices (stopping early if
 # counter exceeds the latter).  Has to pass along lots of ugly
 # configuration info with each recursion, could be much more
-# elegant.
+# elegant.  The images are handed to sink.  zip_source is the
+# (archive, member info) an fhandle was opened from, so images can
+# be copied without recompressing.
 def process_file(
-        final_ofd,
+        sink,
         current_index,
         fname, 
         fhandle=None, 
@@ -87,24 +397,31 @@ def process_file(
         tar_exts=[".tar", ".tgz", ".tbz2", ".tar.gz", ".tar.bz2"],
         old_exts=[".ppt", ".xls"],        
         min_index=0,
-        max_index=None
+        max_index=None,
+        zip_source=None,
+        spool_max_size=DEFAULT_SPOOL_MAX_SIZE
 ):
     # Only keep processing if below upper limit/upper limit not set
     if not (max_index and current_index >= max_index):
-        ext = re.match(r".*?((\.tar)?\.[^\.]+)$", fname.lower())
-        ext = ext.group(1) if ext else None
+        ext = file_extension(fname)
         name = os.path.join(prefix, fname.strip("/"))
         logging.debug("Processing file '%s'", fname)
-        if ext in zip_exts:
+        kind, content_format = classify(fhandle, ext, image_exts, zip_exts, tar_exts, old_exts)
+        metrics.add("members_scanned")
+        if not prefix and fhandle is not None:
+            metrics.add("files_in")
+            metrics.add("bytes_in", os.fstat(fhandle.fileno()).st_size)
+        if kind == ZIP:
             logging.debug("Recursively processing a zip file")
             try:
-                with zipfile.ZipFile(fhandle, "r") as nested_ifd:
-                    for nested_fname in nested_ifd.namelist():
+                with seekable_copy(fhandle, temp_path, spool_max_size) as archive_ifd, \
+                        zipfile.ZipFile(archive_ifd, "r") as nested_ifd:
+                    for nested_info in nested_ifd.infolist():
                         current_index = process_file(
-                            final_ofd,
+                            sink,
                             current_index,
-                            nested_fname,
-                            nested_ifd.open(nested_fname, "r"),
+                            nested_info.filename,
+                            nested_ifd.open(nested_info, "r"),
                             prefix=name,
                             temp_path=temp_path,
                             min_index=min_index,
@@ -112,7 +429,9 @@ def process_file(
                             image_exts=image_exts,
                             zip_exts=zip_exts,
                             old_exts=old_exts,
-                            tar_exts=tar_exts
+                            tar_exts=tar_exts,
+                            spool_max_size=spool_max_size,
+                            zip_source=(nested_ifd, nested_info)
                         )
             except zipfile.BadZipFile as bad_zip_error:
                 logging.info("Unable to open archive at index at %s for file %s. Err msg: %s",
@@ -121,67 +440,327 @@ def process_file(
                 logging.info("Unknown error opening archive at index at %s for file %s. Err msg: %s",
                             current_index, name, unknown_error)
 
-        elif ext in old_exts:
+        elif kind == CFB:
             logging.debug("Treating '%s' as old Microsoft format", fname)
-            input_fname = os.path.join(temp_path, os.path.basename(fname))
-            with open(input_fname, "wb") as ofd:
-                ofd.write(fhandle.read())
-            pid = subprocess.Popen(
-                shlex.split("python -m hachoir.subfile --category image") + [input_fname, temp_path],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            pid.communicate()
-            for output_fname in glob(os.path.join(temp_path, "*")):
-                current_index += 1
-                if output_fname != input_fname:
-                    with open(output_fname, "rb") as nested_ifd:
+            try:
+                with seekable_copy(fhandle, temp_path, spool_max_size) as legacy_ifd:
+                    with metrics.timer("hachoir"):
+                        embedded_images = list(iter_embedded_images(legacy_ifd))
+                    for image_fname, image_offset, image_size in embedded_images:
+                        legacy_ifd.seek(image_offset)
                         current_index = process_file(
-                            final_ofd,
+                            sink,
                             current_index,
-                            os.path.basename(output_fname), 
-                            nested_ifd, 
-                            prefix=name, 
+                            image_fname,
+                            io.BytesIO(legacy_ifd.read(image_size)),
+                            prefix=name,
                             temp_path=temp_path,
                             min_index=min_index,
                             max_index=max_index,
                             image_exts=image_exts,
                             zip_exts=zip_exts,
                             old_exts=old_exts,
-                            tar_exts=tar_exts
+                            tar_exts=tar_exts,
+                            spool_max_size=spool_max_size
                         )
-                os.remove(output_fname)
-        elif ext in image_exts:
+            except Exception as unknown_error:
+                logging.info("Unknown error searching old format file at index at %s for file %s. Err msg: %s",
+                             current_index, name, unknown_error)
+        elif kind == IMAGE:
+            if content_format and ext not in IMAGE_FORMAT_EXTENSIONS[content_format]:
+                # an image with a wrong or missing extension is named for its format
+                name += next(image_ext for image_ext in image_exts
+                             if image_ext in IMAGE_FORMAT_EXTENSIONS[content_format])
             current_index += 1
+            metrics.add("images_extracted")
             if current_index > min_index:
                 logging.debug("Adding image to archive as '%s'", name)
-                with final_ofd.open(name, "w") as image_ofd:
-                    image_ofd.write(fhandle.read())
+                sink.add(name, fhandle, current_index, zip_source)
             else:
                 logging.debug("Skipping image '%s'", name)
-        elif ((sys.version_info >= (3,9) and tarfile.is_tarfile(fhandle)) or ext in tar_exts):
+        elif kind in (TAR, COMPRESSED):
             logging.debug("Recursively processing a tar file")
-            with tarfile.open(fileobj=fhandle) as nested_ifd:
-                for member in nested_ifd:
-                    current_index = process_file(
-                        final_ofd,
-                        current_index,
-                        member.name,
-                        nested_ifd.extractfile(member),
-                        prefix=name,
-                        temp_path=temp_path,
-                        min_index=min_index,
-                        max_index=max_index,
-                        image_exts=image_exts,
-                        zip_exts=zip_exts,
-                        old_exts=old_exts,
-                        tar_exts=tar_exts
-                    )
+            try:
+                with seekable_copy(fhandle, temp_path, spool_max_size) as archive_ifd, \
+                        tarfile.open(fileobj=archive_ifd) as nested_ifd:
+                    for member in nested_ifd:
+                        current_index = process_file(
+                            sink,
+                            current_index,
+                            member.name,
+                            nested_ifd.extractfile(member),
+                            prefix=name,
+                            temp_path=temp_path,
+                            min_index=min_index,
+                            max_index=max_index,
+                            image_exts=image_exts,
+                            zip_exts=zip_exts,
+                            old_exts=old_exts,
+                            tar_exts=tar_exts,
+                            spool_max_size=spool_max_size
+                        )
+            except tarfile.ReadError as bad_tar_error:
+                logging.info("Unable to open archive at index at %s for file %s. Err msg: %s",
+                             current_index, name, bad_tar_error)
         else:
             logging.debug("Skipping file with unknown extension/content ('%s')", fname)
     return current_index
 
 
+def iter_input_files(input_dirs):
+    """
+    Yield the files under the input directories in sorted order, so that the image indices used by --start and --count
+    do not depend on the order the file system lists them in
+    """
+    for input_dir in input_dirs:
+        for dirpath, dirnames, filenames in os.walk(input_dir):
+            dirnames.sort()
+            for file_name in sorted(filenames):
+                yield os.path.join(dirpath, file_name)
+
+
+class ExtractionJournal:
+    """
+    Append-only JSONL journal of an extraction run. The first line names the output archive, then every finished
+    top-level input gets a line with its number of images, the image index after it and the size of the output
+    archive after its images, so that an interrupted run can be resumed after the last finished input.
+    """
+
+    def __init__(self, path, output, current_index=0, records=()):
+        self.path = path
+        # the journal is rewritten next to the old one and swapped in, so a crash meanwhile leaves the old one intact
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as temp_ofd:
+            for entry in [{"output": output}, *records]:
+                temp_ofd.write(json.dumps(entry) + "\n")
+        os.replace(temp_path, path)
+        self._ofd = open(path, "a")
+        self._previous_index = current_index
+
+    def _write(self, entry):
+        self._ofd.write(json.dumps(entry) + "\n")
+        self._ofd.flush()
+
+    def record(self, fname, current_index, ofd):
+        # the archive is flushed first, so that everything the journal points to is on disk
+        ofd.fp.flush()
+        self._write({"input": fname, "images": current_index - self._previous_index, "index": current_index,
+                     "offset": ofd.start_dir})
+        self._previous_index = current_index
+
+    def close(self):
+        self._ofd.close()
+
+
+def read_journal(path):
+    """
+    The output archive and the records of the finished inputs in a journal. Records past the end of the output (data
+    the operating system had not written when the machine went down) are dropped, as is a last line cut off by a crash.
+    Raises ValueError if the journal does not name an output archive.
+    """
+    output, records = None, []
+    with open(path) as journal_ifd:
+        for line in journal_ifd:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            if "output" in entry:
+                output = entry["output"]
+            else:
+                records.append(entry)
+    if output is None:
+        raise ValueError(f"the journal {path} does not name an output archive")
+    output_size = os.path.getsize(output) if os.path.exists(output) else 0
+    return output, [record for record in records if record["offset"] <= output_size]
+
+
+def read_input_list(path):
+    """
+    The inputs named in a text file, one per line, e.g. a batch written by plan_batches.py. Blank lines and lines
+    starting with '#' are skipped.
+    """
+    with open(path) as ifd:
+        return [line.strip() for line in ifd if line.strip() and not line.startswith("#")]
+
+
+def top_level_files(inputs, input_dir):
+    return inputs if input_dir.upper() == 'FALSE' else iter_input_files(inputs)
+
+
+def build_manifest(manifest_path, fnames, temp_path, args):
+    """
+    Write the index of every image in the inputs to a CSV manifest. The inputs are walked as in an extraction, so that
+    the indices match, but no images are written: members are still sniffed, nested archives copied out and old format
+    files searched. Returns the number of images.
+    """
+    current_index = 0
+    with open(manifest_path, "w", newline="") as manifest_ofd:
+        manifest_writer = csv.writer(manifest_ofd)
+        manifest_writer.writerow(MANIFEST_COLUMNS)
+        for fname in fnames:
+            sink = CountingSink()
+            with open(fname, "rb") as ifd:
+                current_index = process_file(
+                    sink,
+                    current_index,
+                    fname,
+                    fhandle=ifd,
+                    temp_path=temp_path,
+                    image_exts=args.image_extensions,
+                    zip_exts=args.zip_extensions,
+                    old_exts=args.old_extensions,
+                    tar_exts=args.tar_extensions,
+                    spool_max_size=args.spool_max_size
+                )
+            manifest_writer.writerows((fname, name, index) for name, index in sink.images)
+            logging.info("Counted top-level file '%s', at index: %s", fname, current_index)
+    return current_index
+
+
+def files_from_manifest(manifest_path, min_index=0, max_index=None):
+    """
+    Find the top-level files holding the images with indices in (min_index, max_index] in a manifest. Returns them in
+    input order, together with the index before the first image of the first of them, so that a batch can start there
+    instead of counting the images of all the files before it. Files without images are not in the manifest, which
+    does not change the indices.
+    """
+    fnames, start_index = [], 0
+    current_fname, current_first_index = None, None
+    with open(manifest_path, newline="") as manifest_ifd:
+        for row in csv.DictReader(manifest_ifd):
+            index = int(row["image_index"])
+            if row["top_level_file"] != current_fname:
+                current_fname, current_first_index = row["top_level_file"], index
+            if index <= min_index:
+                continue
+            if max_index and index > max_index:
+                break
+            if not fnames or fnames[-1] != current_fname:
+                if not fnames:
+                    start_index = current_first_index - 1
+                fnames.append(current_fname)
+    return fnames, start_index
+
+
+def extract_document(task):
+    """
+    Extract every image of one top-level document into its own shard archive. This runs in the worker processes, which
+    do not know how many images the documents before theirs hold, so the images are indexed within the document and
+    the merge assigns the global indices. Returns (file name, shard path, index of every image in the shard, number of
+    indices the document used).
+    """
+    position, fname, temp_path, args = task
+    shard_path = os.path.join(temp_path, f"document_{position:09d}.zip")
+    with zipfile.ZipFile(shard_path, "w") as shard_ofd, open(fname, "rb") as ifd:
+        sink = ShardImageSink(shard_ofd, args.hash_algo if args.inline_dedup_csv else None)
+        index_count = process_file(
+            sink,
+            0,
+            fname,
+            fhandle=ifd,
+            temp_path=temp_path,
+            image_exts=args.image_extensions,
+            zip_exts=args.zip_extensions,
+            old_exts=args.old_extensions,
+            tar_exts=args.tar_extensions,
+            spool_max_size=args.spool_max_size
+        )
+    # the metrics of the worker go back to the main process with the document
+    return fname, shard_path, sink.indices, sink.hashes, index_count, metrics.REGISTRY.drain()
+
+
+def _merge_worker_metrics(result):
+    *document, worker_metrics = result
+    metrics.REGISTRY.merge(worker_metrics)
+    return tuple(document)
+
+
+def iter_extracted_documents(fnames, temp_path, args):
+    """
+    Extract the documents in a pool of worker processes and yield the results in input order. Each idle worker takes
+    the next document, so a slow document only holds up its own worker, while the number of documents extracted ahead
+    of the one being merged stays bounded.
+    """
+    window = args.workers * PENDING_DOCUMENTS_PER_WORKER
+    # the options go to the workers with every document, without the inputs, which may be a generator (partial loads)
+    # that cannot be pickled and that the workers do not use
+    worker_args = argparse.Namespace(**{key: value for key, value in vars(args).items() if key != "inputs"})
+    # the workers start with an empty registry, not with a copy of what the main process has counted so far
+    with multiprocessing.Pool(args.workers, initializer=metrics.REGISTRY.drain) as pool:
+        pending = deque()
+        for position, fname in enumerate(fnames):
+            pending.append(pool.apply_async(extract_document, ((position, fname, temp_path, worker_args),)))
+            if len(pending) >= window:
+                yield _merge_worker_metrics(pending.popleft().get())
+        while pending:
+            yield _merge_worker_metrics(pending.popleft().get())
+
+
+def skip_to_start(ofd, fnames, temp_path, args, min_index, current_index=0, journal=None):
+    """
+    Count the images of the documents that end at or before min_index, without extracting them, as the sequential
+    path walks them without writing. Returns the documents from the first one holding an image past min_index on, and
+    the index before it.
+    """
+    fnames = iter(fnames)
+    for fname in fnames:
+        # the metrics of each document are kept apart, as the one that goes to the workers is counted there again
+        earlier_metrics = metrics.REGISTRY.drain()
+        with open(fname, "rb") as ifd:
+            next_index = process_file(
+                CountingSink(),
+                current_index,
+                fname,
+                fhandle=ifd,
+                temp_path=temp_path,
+                image_exts=args.image_extensions,
+                zip_exts=args.zip_extensions,
+                old_exts=args.old_extensions,
+                tar_exts=args.tar_extensions,
+                spool_max_size=args.spool_max_size
+            )
+        document_metrics = metrics.REGISTRY.drain()
+        metrics.REGISTRY.merge(earlier_metrics)
+        if next_index > min_index:
+            return itertools.chain([fname], fnames), current_index
+        metrics.REGISTRY.merge(document_metrics)
+        current_index = next_index
+        logging.info("Skipped top-level file '%s' before --start, at index: %s", fname, current_index)
+        if journal is not None:
+            journal.record(fname, current_index, ofd)
+    return iter(()), current_index
+
+
+def extract_parallel(ofd, fnames, temp_path, args, min_index=0, max_index=None, current_index=0, dedup_csv=None,
+                     journal=None):
+    """
+    Extract the documents with worker processes and merge their shards into ofd in input order. An image gets the
+    index it would have had in a sequential run, and is kept under the same --start/--count rule. The documents
+    before --start are only counted, here, and never go to the workers. With dedup_csv, the workers hash the images and
+    repeated content is dropped here, in input order, as in a sequential run.
+    """
+    if current_index < min_index:
+        fnames, current_index = skip_to_start(ofd, fnames, temp_path, args, min_index, current_index, journal)
+    for fname, shard_path, indices, hashes, index_count in iter_extracted_documents(fnames, temp_path, args):
+        with zipfile.ZipFile(shard_path, "r") as shard_ifd:
+            for position, (local_index, info) in enumerate(zip(indices, shard_ifd.infolist())):
+                index = current_index + local_index
+                if index > min_index and not (max_index and index > max_index):
+                    if dedup_csv is None or dedup_csv.record(info.filename, index, hashes[position]):
+                        copy_raw_member(shard_ifd, info, ofd)
+                        metrics.add("images_written")
+                        metrics.add("bytes_out", info.file_size)
+        os.remove(shard_path)
+        current_index += index_count
+        logging.info("Done processing top-level file '%s', at index: %s", fname, current_index)
+        if journal is not None:
+            journal.record(fname, current_index, ofd)
+        if max_index and current_index >= max_index:
+            break
+    return current_index
+
+
 def format_duration(seconds):
     hours, remainder = divmod(seconds, 3600)
     minutes, seconds = divmod(remainder, 60)
@@ -194,7 +773,7 @@ if __name__ == "__main__":
     parser.add_argument(
         dest="inputs", 
         nargs="*",
-        help="Any number and mixture of Powerpoint and Excel files to process (or zip/tar files in archive mode). "
+        help="Any number and mixture of Powerpoint and Excel files to process, and zip/tar files of them. "
              "If specifying input_dir=TRUE, then this should be a directory.",
     )
     parser.add_argument("--working_dir",
@@ -210,6 +789,11 @@ if __name__ == "__main__":
                              "input_dir is specified in the yaml config. This will default to TRUE",
                         choices=["TRUE", "FALSE", "true", "false"],
                         required=False)
+    parser.add_argument("--input_list",
+                        dest="input_list",
+                        help="Text file naming an input file on every line, e.g. a batch written by plan_batches.py. "
+                             "The files are processed after any given on the command line.",
+                        required=False)
     parser.add_argument("--partial_load_query",
                         dest="partial_load_query",
                         help="If supplying a partial load query, then a partial load of files will be added to the "
@@ -232,6 +816,10 @@ if __name__ == "__main__":
                              "the system root directory.",
                         required=False
                         )
+    parser.add_argument("--partial_load_queue_depth", dest="partial_load_queue_depth",
+                        default=DEFAULT_PARTIAL_LOAD_QUEUE_DEPTH, type=int,
+                        help="Number of partial load ids that are requested from Solr and resolved to paths ahead of "
+                             "the extraction")
     parser.add_argument("--cache_dir",
                    dest="cache_dir",
                    help="Directory for caching temporary files and Solr results during processing",
@@ -251,6 +839,36 @@ if __name__ == "__main__":
     parser.add_argument("--config_file",
                         dest="config_file",
                         help="Overrides the default location of the process_config.yaml.")
+    parser.add_argument("--build_manifest", dest="build_manifest",
+                        help="Instead of extracting images, write a CSV manifest of the index of every image in the "
+                             "inputs, for batches run with --manifest. The inputs are walked as in an extraction, but "
+                             "no images are written.")
+    parser.add_argument("--manifest", dest="manifest",
+                        help="Manifest written by --build_manifest for the same inputs. The inputs are then taken from "
+                             "the manifest, and only the files holding images between --start and --start + --count "
+                             "are processed.")
+    parser.add_argument("--spool_max_size", dest="spool_max_size", default=DEFAULT_SPOOL_MAX_SIZE, type=int,
+                        help="Archives nested in other archives (e.g. a pptx in a zip) up to this many bytes are held "
+                             "in memory while they are processed, larger ones are spilled to a temporary file. This "
+                             "bounds the memory used per nesting level. Default is 64 MB.")
+    parser.add_argument("--inline_dedup_csv", dest="inline_dedup_csv",
+                        help="Hash the images while extracting them and write each distinct content only once. Every "
+                             "extracted image is listed in this CSV with its hash and the name its content is stored "
+                             "under in the output.")
+    parser.add_argument("--hash_algo", dest="hash_algo", choices=available_hash_algos(), default=DEFAULT_HASH_ALGO,
+                        help="Hash algorithm of --inline_dedup_csv. Default is md5, as in dedup_images.py.")
+    parser.add_argument("--journal", dest="journal",
+                        help="JSONL file recording every finished top-level input, with its number of images and the "
+                             "size of the output after it, so that an interrupted run can be continued with --resume")
+    parser.add_argument("--resume", dest="resume", default=False, action="store_true",
+                        help="Continue the run recorded in --journal: the inputs it finished are skipped and their "
+                             "images are kept, the output archive is cut back to the end of the last finished input "
+                             "and the remaining images are appended to it. The output name is taken from the journal.")
+    parser.add_argument("--workers", dest="workers", default=1, type=int,
+                        help="Number of processes extracting top-level files in parallel. Every file is extracted into "
+                             "its own temporary archive, which are merged into the output in sorted input order, so "
+                             "--start and --count select the same images as with a single process.")
+    metrics.add_metrics_arguments(parser)
     parser.add_argument("--log_level", dest="log_level", choices=["DEBUG", "INFO", "WARN", "ERROR"], default="INFO")
     args = parser.parse_args()
 
@@ -265,12 +883,19 @@ if __name__ == "__main__":
        else:
            args.log_file = 'process.log' # TODO: centralize some defaults, like filenames
 
-    if not args.output:
+    if args.resume and not args.journal:
+        parser.error("--resume requires --journal")
+
+    if not args.output and not args.build_manifest and not args.resume:
         if config:
             args.output = get_config_value(config, 'data_output', 'output_file')
         else:
             parser.error("--output is required when no config file is provided")
 
+    if args.input_list:
+        args.inputs.extend(read_input_list(args.input_list))
+        args.input_dir = 'FALSE'
+
     if not args.input_dir:
         if config and config['data_input']['input_dir']:
             args.input_dir = 'TRUE'
@@ -279,6 +904,12 @@ if __name__ == "__main__":
     if not args.inputs and config and config['data_input']['input_dir']:
         args.inputs.append(config['data_input']['input_dir'])
 
+    if not args.input_dir:
+        args.input_dir = 'FALSE'
+
+    if args.resume and not (args.inputs or args.manifest or args.partial_load_query):
+        parser.error("--resume requires the inputs of the interrupted run")
+
     if args.partial_load_query and not args.partial_load_root_dir:
         # add timestamp to output name for partial loads
         args.output = create_file_name_with_timestamp(args.output)
@@ -298,30 +929,80 @@ if __name__ == "__main__":
     logging.getLogger('').addHandler(file_handler)
     logging.info("Application Logging Initialized")
 
-    # The temporary path is used for invoking the command-line
-    # 'hachoir' tool.
+    # The temporary path holds the per-document archives of parallel
+    # runs.
     temp_path = tempfile.mkdtemp()
 
     if args.partial_load_query:
         logging.info("Processing partial load query: %s", args.partial_load_query)
-        query = SolrSearch(args.partial_load_query)
-        query.search(number=config['partial_load']['total_files_download']) #FIX THIS -- this is the num per page for Solr
-        results = query.ids_and_scores
-        args.inputs = build_partial_load_inputs(results, args.partial_load_root_dir)
+        solr_options = {'cache_dir': args.cache_dir,
+                        'cache_max_age': get_config_value(config, 'partial_load', 'solr_cache_max_age',
+                                                          default=DEFAULT_SOLR_CACHE_MAX_AGE),
+                        'workers': get_config_value(config, 'partial_load', 'solr_workers', default=4)}
+        if get_config_value(config, 'partial_load', 'solr_url'):
+            solr_options['base_url'] = get_config_value(config, 'partial_load', 'solr_url')
+        query = SolrSearch(args.partial_load_query, **solr_options)
+        # extraction starts on the first page of ids while the later pages are still being requested
+        args.inputs = stream_partial_load_inputs(
+            query.iter_ids(number=config['partial_load']['total_files_download']), #FIX THIS -- this is the num per page for Solr
+            args.partial_load_root_dir, args.partial_load_queue_depth)
         args.input_dir = 'TRUE'
         # partial loads append a timestamp to the outname automatically
 
+    if args.build_manifest:
+        try:
+            image_count = build_manifest(args.build_manifest, top_level_files(args.inputs, args.input_dir), temp_path,
+                                         args)
+        finally:
+            shutil.rmtree(temp_path)
+        logging.info("Wrote the manifest of %d images to: %s", image_count, args.build_manifest)
+        logging.info("Manifest run time: " + format_duration(time.time() - start_time))
+        sys.exit(0)
+
     # results should have ffgd0283, ffhd0283, fggd0283
     current_index = 0
+    max_index = args.start + args.count if args.count else None
+    if args.manifest:
+        # only the top-level files holding images of this batch are opened
+        args.inputs, current_index = files_from_manifest(args.manifest, args.start, max_index)
+        args.input_dir = 'FALSE'
+        logging.info("Manifest %s: %d top-level files hold the images of this batch, starting after index %s",
+                     args.manifest, len(args.inputs), current_index)
+    journal, completed, resume_offset = None, set(), None
+    if args.resume:
+        try:
+            args.output, records = read_journal(args.journal)
+        except (OSError, ValueError) as ex:
+            parser.error(f"Unable to resume from --journal: {ex}")
+        completed = {record["input"] for record in records}
+        resume_offset = records[-1]["offset"] if records else 0
+        if records:
+            current_index = records[-1]["index"]
+        logging.info("Resuming %s after %d finished inputs, at index %s", args.output, len(records), current_index)
+        journal = ExtractionJournal(args.journal, args.output, current_index, records)
+    elif args.journal:
+        journal = ExtractionJournal(args.journal, args.output, current_index)
+
+    dedup_csv = None
+    if args.inline_dedup_csv:
+        dedup_csv = InlineDedupCsv(args.inline_dedup_csv, args.hash_algo, current_index if args.resume else None)
     try:
-        with zipfile.ZipFile(args.output, "w") as ofd:
-            if args.input_dir.upper() == 'FALSE':
-                for fname in args.inputs:
+        with metrics.instrumented(args, "process_files"), \
+                (reopen_for_append(args.output, resume_offset) if args.resume
+                 else zipfile.ZipFile(args.output, "w")) as ofd:
+            sink = DedupImageSink(ofd, dedup_csv) if dedup_csv else ZipImageSink(ofd)
+            if args.workers > 1 and args.input_dir.upper() in ('TRUE', 'FALSE'):
+                logging.info("Processing inputs with %d worker processes", args.workers)
+                fnames = (fname for fname in top_level_files(args.inputs, args.input_dir) if fname not in completed)
+                current_index = extract_parallel(ofd, fnames, temp_path, args, args.start, max_index, current_index,
+                                                 dedup_csv, journal)
+            elif args.input_dir.upper() == 'FALSE':
+                for fname in (fname for fname in args.inputs if fname not in completed):
                     logging.info("Processing individual top-level file '%s'", fname)
                     with open(fname, "rb") as ifd:
                         logging.info("Opened top level file '%s'", fname)
                         current_index = process_file(
-                            ofd,
+                            sink,
                             current_index,
                             fname,
                             fhandle=ifd,
@@ -330,38 +1011,55 @@ if __name__ == "__main__":
                             zip_exts=args.zip_extensions,
                             old_exts=args.old_extensions,
                             tar_exts=args.tar_extensions,
+                            spool_max_size=args.spool_max_size,
                             min_index=args.start,
-                            max_index=args.start + args.count if args.count else None
+                            max_index=max_index
                         )
                         logging.info("Done processing top-level file '%s'", fname)
+                    if journal is not None:
+                        journal.record(fname, current_index, ofd)
             elif args.input_dir.upper() == 'TRUE':
                 logging.info("Processing input directory")
-                for dir in args.inputs:
-                    for dirpath, dirnames, filenames in os.walk(dir):
-                        for file_name in filenames:
-                            file_path = os.path.join(dirpath, file_name)
-                            with open(file_path, "rb") as ifd:
-                                logging.info("Open file in input directory '%s'", file_path)
-                                current_index = process_file(
-                                    ofd,
-                                    current_index,
-                                    file_path,
-                                    fhandle=ifd,
-                                    temp_path=temp_path,
-                                    image_exts=args.image_extensions,
-                                    zip_exts=args.zip_extensions,
-                                    old_exts=args.old_extensions,
-                                    tar_exts=args.tar_extensions,
-                                    min_index=args.start,
-                                    max_index=args.start + args.count if args.count else None
-                                )
-                                logging.info("Processed file at index: %s", current_index)
+                for file_path in (fname for fname in iter_input_files(args.inputs) if fname not in completed):
+                    with open(file_path, "rb") as ifd:
+                        logging.info("Open file in input directory '%s'", file_path)
+                        current_index = process_file(
+                            sink,
+                            current_index,
+                            file_path,
+                            fhandle=ifd,
+                            temp_path=temp_path,
+                            image_exts=args.image_extensions,
+                            zip_exts=args.zip_extensions,
+                            old_exts=args.old_extensions,
+                            tar_exts=args.tar_extensions,
+                            spool_max_size=args.spool_max_size,
+                            min_index=args.start,
+                            max_index=max_index
+                        )
+                        logging.info("Processed file at index: %s", current_index)
+                    if journal is not None:
+                        journal.record(file_path, current_index, ofd)
             else:
                 logging.error("No specified input directory or file names.")
     except Exception as e:
         raise e
     finally:
-        # Clean up temporary path used for hachoir subprocesses.
+        # Clean up temporary path used for the per-document archives.
         shutil.rmtree(temp_path)
+        if dedup_csv is not None:
+            dedup_csv.close()
+        if journal is not None:
+            journal.close()
+
+    if dedup_csv is not None:
+        logging.info("Inline dedup: %d repeated images were not written again, see %s", dedup_csv.duplicates,
+                     dedup_csv.path)
 
     logging.info("Image extraction run time: " + format_duration(time.time() - start_time))
+    if peak_memory_mb() is not None:
+        if args.workers > 1:
+            logging.info("Peak memory use (RSS): %.1f MB in the main process, %.1f MB in the largest worker",
+                         peak_memory_mb(), peak_memory_mb(children=True))
+        else:
+            logging.info("Peak memory use (RSS): %.1f MB", peak_memory_mb())
@@ -0,0 +1,89 @@
+import argparse
+import csv
+import logging
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from process_files import format_duration
+
+PROCESS_FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "process_files.py")
+
+
+def read_batches(manifest_path):
+    with open(manifest_path, newline="") as manifest_ifd:
+        return list(csv.DictReader(manifest_ifd))
+
+
+def is_done(row):
+    """
+    Whether the output of a batch is there and newer than its input list, as SCons decides it
+    """
+    return os.path.exists(row['output']) and os.path.getmtime(row['output']) >= os.path.getmtime(row['input_list'])
+
+
+def run_batch(row, process_args):
+    """
+    Run process_files.py on the inputs of a batch. The output is written under a temporary name and only renamed when
+    the batch succeeds, so that a failed batch is run again. '{batch}' in process_args is replaced by the batch number,
+    e.g. for a --journal per batch. The log of the batch goes next to its output. Returns the exit code.
+    """
+    base_path = os.path.splitext(row['output'])[0]
+    partial_output = row['output'] + ".part"
+    command = [sys.executable, PROCESS_FILES, "--input_list", row['input_list'], "--output", partial_output]
+    command += [arg.replace("{batch}", row['batch']) for arg in process_args]
+    if "--log_file" not in process_args:
+        command += ["--log_file", base_path + ".log"]
+    os.makedirs(os.path.dirname(row['output']) or ".", exist_ok=True)
+    start_time = time.time()
+    logging.info("Starting batch %s (%s files, %.1f MB)", row['batch'], row['files'], int(row['bytes']) / 1e6)
+    # the console output of the batch, which holds any traceback
+    with open(base_path + ".out", "w") as out_ofd:
+        returncode = subprocess.run(command, stdout=out_ofd, stderr=subprocess.STDOUT).returncode
+    if returncode == 0:
+        os.replace(partial_output, row['output'])
+        logging.info("Finished batch %s in %s", row['batch'], format_duration(time.time() - start_time))
+    else:
+        logging.error("Batch %s failed with exit code %s, see %s", row['batch'], returncode, base_path + ".out")
+    return returncode
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    parser = argparse.ArgumentParser(
+        description="Run the batches planned by plan_batches.py with process_files.py, either all of them in a pool "
+                    "of local processes, or the one of a SLURM array task. Options after a '--' are passed on to "
+                    "process_files.py.")
+    parser.add_argument("manifest", help="Batch manifest (batches.csv) written by plan_batches.py")
+    parser.add_argument("--workers", dest="workers", type=int, default=os.cpu_count(),
+                        help="Number of batches run at the same time (default: number of CPUs)")
+    parser.add_argument("--task_id", dest="task_id", type=int, default=os.environ.get("SLURM_ARRAY_TASK_ID"),
+                        help="Only run the batch in this row of the manifest. Defaults to SLURM_ARRAY_TASK_ID, so that "
+                             "the manifest can be run as a SLURM array job with --array=0-(batches - 1).")
+    parser.add_argument("--force", dest="force", default=False, action="store_true",
+                        help="Also run the batches whose output is newer than their input list")
+    # everything after a '--' is passed on to process_files.py
+    argv = sys.argv[1:]
+    process_args = argv[argv.index("--") + 1:] if "--" in argv else []
+    args = parser.parse_args(argv[:argv.index("--")] if "--" in argv else argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    rows = read_batches(args.manifest)
+    if args.task_id is not None:
+        if not 0 <= int(args.task_id) < len(rows):
+            parser.error(f"--task_id {args.task_id} is beyond the {len(rows)} batches of {args.manifest}")
+        rows = [rows[int(args.task_id)]]
+    pending = [row for row in rows if args.force or not is_done(row)]
+    logging.info("Running %d of %d batches, %d are up to date", len(pending), len(rows), len(rows) - len(pending))
+
+    # the largest batches are started first, so that they do not end up running alone at the end
+    pending.sort(key=lambda row: float(row['estimated_seconds'] or row['bytes']), reverse=True)
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        returncodes = list(executor.map(lambda row: run_batch(row, process_args), pending))
+
+    failed = sum(returncode != 0 for returncode in returncodes)
+    logging.info("Ran %d batches in %s, %d failed", len(pending), format_duration(time.time() - start_time), failed)
+    sys.exit(1 if failed else 0)
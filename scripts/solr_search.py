@@ -1,13 +1,51 @@
-import math
+import hashlib
+import json
+import os
+import re
 import requests
+import time
 import urllib
+from concurrent.futures import ThreadPoolExecutor
 
-from tqdm.auto import trange
+from requests.adapters import HTTPAdapter
+from tqdm.auto import tqdm
+from urllib3.util.retry import Retry
+
+# Solr does not serve results past this row with start= paging, deeper results need a cursorMark
+MAX_START_ROWS = 10000
+
+# Seconds to wait for a page from Solr
+REQUEST_TIMEOUT = 60
+
+
+def normalize_query(query):
+    """
+    The query with runs of white space collapsed, so that queries that only differ in spacing share a cache entry
+    """
+    return re.sub(r'\s+', ' ', query.strip())
+
+
+def create_session(pool_size=4, retries=3):
+    """
+    HTTP session that keeps up to pool_size connections to the server alive and retries failed requests with backoff
+    """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 
 class SolrSearch:
     """
     Solr search class that takes a query and returns a DataFrame of search results
+
+    Requests go through one pooled session. Pages within the first 10,000 results are fetched concurrently by workers
+    threads, deeper results are streamed page by page with a cursorMark. With a cache_dir, the results are kept on disk
+    keyed by the normalized query, so that repeated runs of the same query do not go back to the server for them. The
+    first page is always requested, and the cache is dropped when the number of results has changed since, or when it
+    is older than cache_max_age seconds.
     """
 
     def __init__(self,
@@ -18,16 +56,20 @@ class SolrSearch:
                  format_='json',
                  only_opioids=True,
                  debug_solr=False,
+                 cache_dir=None,
+                 cache_max_age=None,
+                 workers=4,
+                 session=None,
                  ):
 
-        self.query = query
+        self.query = normalize_query(query)
         print(self.query)
 
         # set query format with parentheses
         if not only_opioids:  # if False don't limit to industry:Opioids
-            self.query = '(' + query + ')'
+            self.query = '(' + self.query + ')'
         else:  # only_opioids = True only searches the industry:Opioids
-            self.query = '(' + query + ' AND industry:Opioids)'
+            self.query = '(' + self.query + ' AND industry:Opioids)'
 
         # set base url we submit our query to
         self.base_url = base_url  # default: https://metadata.idl.ucsf.edu/solr/ltdl3/select?q=
@@ -41,6 +83,9 @@ class SolrSearch:
         # set format_
         self.format = format_  # default: 'json'
 
+        # number of pages requested at the same time with start= paging
+        self.workers = workers
+
         # set query url replacing all spaces with %20
         self.url = (self.base_url + self.query + '&rows=' + str(
             self.rows) + '&fl=' + self.field_limiter + '&wt=' + self.format).replace(' ', '%20')
@@ -48,28 +93,50 @@ class SolrSearch:
         if debug_solr:
             self.url = self.url + '&debug=results'
 
-        # get response from server in json and decode it
-        self.response = requests.get(self.url).json()
+        self.session = session if session is not None else create_session(pool_size=workers)
+
+        # get response from server in json and decode it, also with a cache, so that the number of results is current
+        self.response = self._get(self.url)
 
         # number results found for the submitted self.query
         self.number_found = self.response['response']['numFound']
+        docs = self.response['response']['docs']
+
+        # results of earlier runs of the same query, as docs in result order
+        self.cache_path = None
+        self.cache_fetched_at = time.time()
+        cached = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.cache_path = os.path.join(cache_dir, 'solr_' + hashlib.sha256(self.url.encode('utf-8')).hexdigest()
+                                           + '.json')
+            cached = self._read_cache()
+        if cached and cached['number_found'] != self.number_found:
+            print(f'Ignoring cached results from {self.cache_path}: the index now has {self.number_found:,d} results '
+                  f'instead of {cached["number_found"]:,d}')
+            cached = None
+        elif cached and cache_max_age is not None and time.time() - cached.get('fetched_at', 0) > cache_max_age:
+            print(f'Ignoring cached results from {self.cache_path}: older than {cache_max_age} seconds')
+            cached = None
+        if cached:
+            print(f'Using {len(cached["docs"]):,d} cached results from {self.cache_path}')
+            self.cache_fetched_at = cached['fetched_at']
+        self.cached_docs = cached['docs'] if cached else []
 
         # create dictionary of ids and scores
-        ids_and_scores = {x['id']: x['score'] for x in self.response['response']['docs']}
+        ids_and_scores = {x['id']: x['score'] for x in docs}
         # sort it by value in descending order
         self.ids_and_scores = dict(sorted(ids_and_scores.items(), key=lambda x: x[1], reverse=True))
 
-        # dictionary of ids and artifacts
-        try:
-            self.ids_and_artifacts = {x['id']: x['artifact'] for x in self.response['response']['docs']}
-        except KeyError:  # if there aren't any artifacts, like with movies hosted at archive.org we skip those
-            self.ids_without_artifacts = []
-            self.ids_and_artifacts = {}
-            for x in self.response['response']['docs']:
-                try:
-                    self.ids_and_artifacts[x['id']] = x['artifact']
-                except KeyError:
-                    self.ids_without_artifacts.append(x['id'])
+        # dictionary of ids and artifacts, if there aren't any artifacts, like with movies hosted at archive.org we
+        # skip those
+        self.ids_without_artifacts = []
+        self.ids_and_artifacts = {}
+        for x in docs:
+            try:
+                self.ids_and_artifacts[x['id']] = x['artifact']
+            except KeyError:
+                self.ids_without_artifacts.append(x['id'])
 
         # list of ids
         self.ids = sorted(self.ids_and_scores.keys())
@@ -77,6 +144,110 @@ class SolrSearch:
         # number of results downloaded for the submitted self.query
         self.number_received = len(self.ids)
 
+    def _get(self, url):
+        response = self.session.get(url, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+
+    def _read_cache(self):
+        try:
+            with open(self.cache_path) as cache_file:
+                cached = json.load(cache_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return cached if cached.get('url') == self.url else None
+
+    def _write_cache(self, docs):
+        # written to a temporary file first, so that an interrupted run never leaves a truncated cache behind
+        temp_cache_path = self.cache_path + '.tmp'
+        with open(temp_cache_path, 'w') as cache_file:
+            # the time the first cached results were fetched, extending the cache does not make them newer
+            json.dump({'url': self.url, 'number_found': self.number_found, 'fetched_at': self.cache_fetched_at,
+                       'docs': docs}, cache_file)
+        os.replace(temp_cache_path, self.cache_path)
+
+    def _sorted_url(self):
+        # sort by relevancy score + desc and use id + asc sort for tie-breaker if matching relevancy scores, so that
+        # every page continues where the previous one ended
+        return self.url + '&sort=score+desc,id+asc'
+
+    def _fetch_start_page(self, start):
+        # get response from Solr API, starting at result number start
+        return self._get(self._sorted_url() + '&start=' + str(start))['response']['docs']
+
+    def _iter_start_pages(self, number, first):
+        """
+        Pages of the results from result number first up to number, fetched by self.workers concurrent requests and
+        yielded in result order
+        """
+        starts = range(first, number, self.rows)
+        with ThreadPoolExecutor(self.workers) as executor:
+            yield from executor.map(self._fetch_start_page, starts)
+
+    def _iter_cursor_pages(self):
+        """
+        Pages of all results, one request after the other: each request needs the cursorMark the previous one returned
+        """
+        # set cursorMark for first iteration as an asterisk
+        self.cursorMark = '*'
+        while True:
+            self.response = self._get(self._sorted_url() + '&cursorMark=' + self.cursorMark)
+            docs = self.response['response']['docs']
+            if docs:
+                yield docs
+            next_cursorMark = self.response['nextCursorMark']
+            if not docs or urllib.parse.quote_plus(next_cursorMark) == self.cursorMark:
+                break
+            # quote_plus the next_cursorMark value so it is properly handled
+            # in the case of special characters like '+'
+            self.cursorMark = urllib.parse.quote_plus(next_cursorMark)
+
+    def iter_pages(self, number):
+        """
+        Yield the first number results page by page as lists of docs, in result order. Cached results are yielded
+        first, only the results past them are requested. A run that gets all number results extends the cache.
+        """
+        docs = self.cached_docs[:number]
+        if docs:
+            yield docs
+        received = docs
+        if len(received) < number:
+            received = list(received)
+            if number > MAX_START_ROWS:
+                # a cursorMark can't start in the middle, the pages the cache already has are skipped
+                pages = self._iter_cursor_pages()
+                skip = len(received)
+            else:
+                pages = self._iter_start_pages(number, len(received))
+                skip = 0
+            for page in pages:
+                skipped = min(skip, len(page))
+                skip -= skipped
+                page = page[skipped:number - len(received) + skipped]
+                if page:
+                    received.extend(page)
+                    yield page
+                if len(received) >= number:
+                    break
+            if self.cache_path and len(received) > len(self.cached_docs):
+                self.cached_docs = received
+                self._write_cache(received)
+
+    def _number_to_return(self, number):
+        if str(number).lower() == 'all' or number > self.number_found:
+            # set number to the total number of results found for our query
+            return self.number_found
+        return number
+
+    def iter_ids(self, number=10000):
+        """
+        Yield the ids of the first number results (or 'all') in result order, as their pages arrive. Unlike search(),
+        nothing is collected, so the caller can start working on the first ids while later pages are requested.
+        """
+        for docs in self.iter_pages(self._number_to_return(number)):
+            for x in docs:
+                yield x['id']
+
     def search(self, number=10000):
         """
         Get ids from searching self.query.
@@ -84,12 +255,7 @@ class SolrSearch:
         If the request is for over 10,000 rows a "cursorMark" is necessary
         to access all of the results.
         """
-        if str(number).lower() == 'all' or number > self.number_found:
-            # set number to the total number of results found for our query
-            number = self.number_found
-
-        # get number of loops we'll run to request all the data and round up
-        total_loops = math.ceil(number / self.rows)
+        number = self._number_to_return(number)
 
         if number < self.number_found:
             print(f'Running query: {self.query}\nReturning {number:,d} of {self.number_found} results')
@@ -98,64 +264,21 @@ class SolrSearch:
 
         # instantiate a temporary, empty dict to collect our ids and scores in
         temp_ids_and_scores_dict = {}
+        with tqdm(total=number) as progress:
+            for docs in self.iter_pages(number):
+                # parse the new ids and scores from the page and add them to the collected ids
+                temp_ids_and_scores_dict.update({x['id']: x['score'] for x in docs})
+                progress.update(len(docs))
 
-        if number > 10000:  # then we have to use cursorMarks
-
-            # set cursorMark for first iteration as an asterisk
-            self.cursorMark = '*'
-
-            for i in trange(total_loops):
-                # create url by adding adding sort by relevancy score + desc and
-                # use id + asc sort for tie-breaker if matching relevancy scores
-                url = self.url + '&sort=score+desc,id+asc' + '&cursorMark=' + self.cursorMark
-
-                # get response from Solr API
-                self.response = requests.get(url).json()
-
-                # parse the new ids and scores from the response
-                new_ids_and_scores_dict = {x['id']: x['score'] for x in self.response['response']['docs']}
-
-                # add dict of new ids to collected ids
-                temp_ids_and_scores_dict.update(new_ids_and_scores_dict)
-
-                next_cursorMark = self.response['nextCursorMark']
-
-                # quote_plus the next_cursorMark value so it is properly handled
-                # in the case of special characters like '+'
-                self.cursorMark = urllib.parse.quote_plus(next_cursorMark)
-
+        if number > MAX_START_ROWS:
             # update our self.ids_dict and the total results in case we want to manually quit
             self.ids_dict = temp_ids_and_scores_dict
             print(f'Search results complete: {len(self.ids_dict):,d} results')
 
-
-        else:  # we assume number <= 10000 and we request results with starting row
-
-            # request data from the Solr API equal to
-            # (total requested) / (number of rows requested at a time)
-            for i in trange(total_loops):  # defaults: 10000 / 1000
-
-                # set start value to iteration times number of rows requested as a string
-                start = str(i * self.rows)
-
-                # # create url by adding adding sort by relevancy score + desc and
-                # use id + asc sort for tie-breaker if matching relevancy scores
-                # followed by the starting result value
-                url = self.url + '&sort=score+desc,id+asc' + '&start=' + start
-
-                # get response from Solr API
-                self.response = requests.get(url).json()
-
-                # parse the new ids and scores from the response
-                new_ids_and_scores_dict = {x['id']: x['score'] for x in self.response['response']['docs']}
-
-                # add dict of new ids to collected ids
-                temp_ids_and_scores_dict.update(new_ids_and_scores_dict)
-
         # update self.ids and self.number_received
         # NOTE: we don't update the search url or original response
         self.ids_and_scores = temp_ids_and_scores_dict
         self.ids = list(self.ids_and_scores.keys())
         self.scores = list(self.ids_and_scores.values())
         self.number_received = len(self.ids)
-        print(f'Number of results received: {self.number_received:,d}\n')
\ No newline at end of file
+        print(f'Number of results received: {self.number_received:,d}\n')
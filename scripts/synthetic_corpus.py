@@ -0,0 +1,168 @@
+import argparse
+import io
+import os
+import random
+import tarfile
+import zipfile
+
+from PIL import Image
+
+# Signature of the Compound File Binary container of the old Office formats
+CFB_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+# Kinds of top-level documents, cycled through in this order
+DOCUMENT_KINDS = ['pptx', 'xlsx', 'ppt', 'xls', 'zip', 'tar', 'tar.gz']
+
+# Media folder of the images in each OOXML document kind
+MEDIA_DIRS = {'pptx': 'ppt/media', 'xlsx': 'xl/media'}
+
+
+class ImageFactory:
+    """
+    Makes the images of a synthetic corpus: noisy JPEGs and PNGs that pass the default filter thresholds, and a share of
+    flat, low entropy images that do not. With probability duplicate_ratio an image repeats one made before, byte for
+    byte, as logos and templates do in the real corpus.
+    """
+
+    def __init__(self, rng, image_size=400, duplicate_ratio=0.2, low_entropy_ratio=0.1):
+        self.rng = rng
+        self.image_size = image_size
+        self.duplicate_ratio = duplicate_ratio
+        self.low_entropy_ratio = low_entropy_ratio
+        self.made = []
+        self.images = 0
+        self.image_bytes = 0
+
+    def _new_image(self):
+        width = self.rng.randint(self.image_size // 2, self.image_size)
+        height = self.rng.randint(self.image_size // 2, self.image_size)
+        if self.rng.random() < self.low_entropy_ratio:
+            im = Image.new('RGB', (width, height), tuple(self.rng.randrange(256) for _ in range(3)))
+        else:
+            im = Image.frombytes('RGB', (width, height), self.rng.randbytes(width * height * 3))
+        image_format = self.rng.choice(['JPEG', 'PNG'])
+        data = io.BytesIO()
+        im.save(data, image_format)
+        return ('.jpg' if image_format == 'JPEG' else '.png'), data.getvalue()
+
+    def make(self):
+        """
+        Returns (extension, image bytes) of the next image
+        """
+        if self.made and self.rng.random() < self.duplicate_ratio:
+            ext, data = self.rng.choice(self.made)
+        else:
+            ext, data = self._new_image()
+            # keeps the earlier images to repeat bounded
+            if len(self.made) < 200:
+                self.made.append((ext, data))
+        self.images += 1
+        self.image_bytes += len(data)
+        return ext, data
+
+
+def ooxml_document(factory, kind, images_per_document):
+    """
+    Bytes of a pptx or xlsx like zip archive: some XML parts and the images under the media folder
+    """
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr('[Content_Types].xml', '<?xml version="1.0"?><Types/>' + ' ' * 2000)
+        for i in range(images_per_document):
+            ext, image = factory.make()
+            # images are stored, as Office does for formats that are already compressed
+            zip_ref.writestr(zipfile.ZipInfo(f'{MEDIA_DIRS[kind]}/image{i + 1}{ext}'), image)
+    return data.getvalue()
+
+
+def legacy_document(factory, images_per_document):
+    """
+    Bytes of a ppt or xls like blob: the CFB signature, then the images between runs of random filler, which is how
+    the old formats embed them as far as the hachoir search is concerned
+    """
+    parts = [CFB_SIGNATURE, factory.rng.randbytes(504)]
+    for _ in range(images_per_document):
+        parts.append(factory.make()[1])
+        parts.append(factory.rng.randbytes(factory.rng.randint(512, 4096)))
+    return b''.join(parts)
+
+
+def build_corpus(corpus_dir, num_documents=60, images_per_document=5, image_size=400, duplicate_ratio=0.2,
+                 low_entropy_ratio=0.1, kinds=DOCUMENT_KINDS, seed=0):
+    """
+    Write num_documents top-level files to corpus_dir, cycling through kinds: pptx and xlsx with embedded media, ppt and
+    xls like CFB blobs, and zip, tar and tar.gz archives holding a pptx and a ppt each. Returns a dict describing the
+    corpus.
+    """
+    rng = random.Random(seed)
+    factory = ImageFactory(rng, image_size, duplicate_ratio, low_entropy_ratio)
+    os.makedirs(corpus_dir, exist_ok=True)
+    for i in range(num_documents):
+        kind = kinds[i % len(kinds)]
+        path = os.path.join(corpus_dir, f'doc_{i:05d}.{kind}')
+        if kind in MEDIA_DIRS:
+            with open(path, 'wb') as ofd:
+                ofd.write(ooxml_document(factory, kind, images_per_document))
+        elif kind in ('ppt', 'xls'):
+            with open(path, 'wb') as ofd:
+                ofd.write(legacy_document(factory, images_per_document))
+        elif kind == 'zip':
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+                zip_ref.writestr(f'nested_{i:05d}.pptx', ooxml_document(factory, 'pptx', images_per_document))
+                zip_ref.writestr(f'nested_{i:05d}.ppt', legacy_document(factory, images_per_document))
+        elif kind in ('tar', 'tar.gz'):
+            with tarfile.open(path, 'w:gz' if kind == 'tar.gz' else 'w') as tar_ref:
+                for name, data in [(f'nested_{i:05d}.pptx', ooxml_document(factory, 'pptx', images_per_document)),
+                                   (f'nested_{i:05d}.ppt', legacy_document(factory, images_per_document))]:
+                    member = tarfile.TarInfo(name)
+                    member.size = len(data)
+                    tar_ref.addfile(member, io.BytesIO(data))
+        else:
+            raise ValueError(f"Unknown document kind '{kind}', expected one of {DOCUMENT_KINDS}")
+    return {
+        'documents': num_documents,
+        'images': factory.images,
+        'image_bytes': factory.image_bytes,
+        'corpus_bytes': sum(os.path.getsize(os.path.join(corpus_dir, fname)) for fname in os.listdir(corpus_dir)),
+        'images_per_document': images_per_document,
+        'image_size': image_size,
+        'duplicate_ratio': duplicate_ratio,
+        'low_entropy_ratio': low_entropy_ratio,
+        'kinds': list(kinds),
+        'seed': seed,
+    }
+
+
+def add_corpus_arguments(parser):
+    """
+    Add the options of build_corpus to an argument parser
+    """
+    parser.add_argument("--documents", dest="documents", type=int, default=60, help="Number of top-level files")
+    parser.add_argument("--images_per_document", dest="images_per_document", type=int, default=5,
+                        help="Images per document, nested archives hold two documents")
+    parser.add_argument("--image_size", dest="image_size", type=int, default=400,
+                        help="Largest width and height of the images in pixels, the smallest is half of it")
+    parser.add_argument("--duplicate_ratio", dest="duplicate_ratio", type=float, default=0.2,
+                        help="Share of the images that repeat an earlier one")
+    parser.add_argument("--low_entropy_ratio", dest="low_entropy_ratio", type=float, default=0.1,
+                        help="Share of flat images that the entropy filter drops")
+    parser.add_argument("--kinds", dest="kinds", nargs="+", choices=DOCUMENT_KINDS, default=DOCUMENT_KINDS,
+                        help="Kinds of top-level files, cycled through")
+    parser.add_argument("--seed", dest="seed", type=int, default=0)
+
+
+def corpus_from_args(corpus_dir, args):
+    return build_corpus(corpus_dir, args.documents, args.images_per_document, args.image_size, args.duplicate_ratio,
+                        args.low_entropy_ratio, args.kinds, args.seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a reproducible synthetic corpus of Office documents and "
+                                                 "archives with embedded images")
+    parser.add_argument("corpus_dir", help="Directory to write the corpus to")
+    add_corpus_arguments(parser)
+    args = parser.parse_args()
+
+    corpus = corpus_from_args(args.corpus_dir, args)
+    print(f"Wrote {corpus['documents']} documents with {corpus['images']} images "
+          f"({corpus['corpus_bytes'] / 1e6:.1f} MB) to {args.corpus_dir}")
@@ -0,0 +1,277 @@
+import os
+import shutil
+import struct
+import time
+import zipfile
+
+# Read size used when copying member data into an output archive
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Formats that are already compressed, deflating them again costs CPU time for little or no gain
+COMPRESSED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.jp2', '.pdf', '.zip', '.pptx', '.xlsx', '.docx',
+                         '.gz', '.tgz', '.bz2', '.tbz2'}
+
+COMPRESSION_POLICIES = ['auto', 'stored', 'deflated']
+
+# General purpose flag bits of a zip member header
+_FLAG_ENCRYPTED = 0x1
+_FLAG_DATA_DESCRIPTOR = 0x8
+_FLAG_UTF8_NAME = 0x800
+
+
+def compression_for(arcname, policy='auto'):
+    """
+    Pick the zip compression method for a member. 'auto' stores formats that are already compressed and deflates the
+    rest, 'stored' and 'deflated' apply to every member.
+    """
+    if policy == 'stored':
+        return zipfile.ZIP_STORED
+    if policy == 'deflated':
+        return zipfile.ZIP_DEFLATED
+    if policy == 'auto':
+        ext = os.path.splitext(arcname)[1].lower()
+        return zipfile.ZIP_STORED if ext in COMPRESSED_EXTENSIONS else zipfile.ZIP_DEFLATED
+    raise ValueError(f"Unknown compression policy '{policy}', expected one of {COMPRESSION_POLICIES}")
+
+
+def raw_copy_supported(info):
+    """
+    Whether a member can be copied without decompressing it. Encrypted members cannot, their encryption header may be
+    checked against the data descriptor flag that a raw copy clears.
+    """
+    return not info.flag_bits & _FLAG_ENCRYPTED
+
+
+def _member_data_offset(zip_ref, info):
+    """
+    Offset of the compressed data of a member, which follows its local header. The local header can have a different
+    extra field than the central directory entry, so it has to be read.
+    """
+    with zip_ref._lock:
+        zip_ref.fp.seek(info.header_offset)
+        header = zip_ref.fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local file header for '{info.filename}'")
+    fields = struct.unpack(zipfile.structFileHeader, header)
+    return (info.header_offset + zipfile.sizeFileHeader + fields[zipfile._FH_FILENAME_LENGTH] +
+            fields[zipfile._FH_EXTRA_FIELD_LENGTH])
+
+
+def _iter_raw_data(zip_ref, offset, size):
+    while size > 0:
+        # the archive's file object may be shared with open members, so seek before every read like zipfile does
+        with zip_ref._lock:
+            zip_ref.fp.seek(offset)
+            chunk = zip_ref.fp.read(min(size, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise zipfile.BadZipFile("Truncated member data")
+        offset += len(chunk)
+        size -= len(chunk)
+        yield chunk
+
+
+def copy_raw_member(source_zip, info, dest_zip, arcname=None):
+    """
+    Copy a member of one open zip archive into another as arcname without decompressing it: the compressed bytes, CRC
+    and sizes are taken over as they are, so copying costs sequential I/O only. zipfile has no public API for this, so
+    the member is written the way ZipFile.open(..., 'w') does. Returns the ZipInfo of the new member.
+    """
+    if not raw_copy_supported(info):
+        raise ValueError(f"'{info.filename}' is encrypted and cannot be copied raw")
+    zinfo = zipfile.ZipInfo(arcname or info.filename, date_time=info.date_time)
+    zinfo.compress_type = info.compress_type
+    # the CRC and sizes are known up front, so they go in the local header instead of a trailing data descriptor.
+    # The UTF-8 flag is set again from the new name when the header is written.
+    zinfo.flag_bits = info.flag_bits & ~(_FLAG_DATA_DESCRIPTOR | _FLAG_UTF8_NAME)
+    zinfo.CRC = info.CRC
+    zinfo.compress_size = info.compress_size
+    zinfo.file_size = info.file_size
+    zinfo.external_attr = info.external_attr
+    data_offset = _member_data_offset(source_zip, info)
+    with dest_zip._lock:
+        if dest_zip._writing:
+            raise ValueError("Can't write to the archive while an open writing handle exists")
+        dest_zip._writecheck(zinfo)
+        dest_zip._didModify = True
+        if dest_zip._seekable:
+            dest_zip.fp.seek(dest_zip.start_dir)
+        zinfo.header_offset = dest_zip.fp.tell()
+        dest_zip.fp.write(zinfo.FileHeader())
+        for chunk in _iter_raw_data(source_zip, data_offset, info.compress_size):
+            dest_zip.fp.write(chunk)
+        dest_zip.filelist.append(zinfo)
+        dest_zip.NameToInfo[zinfo.filename] = zinfo
+        dest_zip.start_dir = dest_zip.fp.tell()
+    return zinfo
+
+
+def _dos_date_time(date, time_):
+    return (date >> 9) + 1980, (date >> 5) & 0xF, date & 0x1F, time_ >> 11, (time_ >> 5) & 0x3F, (time_ & 0x1F) * 2
+
+
+def scan_local_headers(fp, end_offset):
+    """
+    Rebuild the ZipInfo of every member before end_offset by walking the local headers from the start of the file.
+    This reads archives whose central directory was never written, as long as the sizes are in the local headers,
+    which zipfile always does when it writes to a seekable file.
+    """
+    infos = []
+    offset = 0
+    while offset < end_offset:
+        fp.seek(offset)
+        header = fp.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f"No local file header at offset {offset}")
+        fields = struct.unpack(zipfile.structFileHeader, header)
+        flag_bits = fields[zipfile._FH_GENERAL_PURPOSE_FLAG_BITS]
+        if flag_bits & _FLAG_DATA_DESCRIPTOR:
+            raise zipfile.BadZipFile(f"The sizes of the member at offset {offset} are not in its local header")
+        name = fp.read(fields[zipfile._FH_FILENAME_LENGTH])
+        extra = fp.read(fields[zipfile._FH_EXTRA_FIELD_LENGTH])
+        info = zipfile.ZipInfo(name.decode('utf-8' if flag_bits & _FLAG_UTF8_NAME else 'cp437'),
+                               _dos_date_time(fields[zipfile._FH_LAST_MOD_DATE], fields[zipfile._FH_LAST_MOD_TIME]))
+        info.flag_bits = flag_bits
+        info.compress_type = fields[zipfile._FH_COMPRESSION_METHOD]
+        info.extract_version = fields[zipfile._FH_EXTRACT_VERSION]
+        info.CRC = fields[zipfile._FH_CRC]
+        info.compress_size = fields[zipfile._FH_COMPRESSED_SIZE]
+        info.file_size = fields[zipfile._FH_UNCOMPRESSED_SIZE]
+        info.header_offset = offset
+        # large members have their sizes in a zip64 extra field, the central directory gets a new one when written
+        while len(extra) >= 4:
+            extra_id, extra_size = struct.unpack('<HH', extra[:4])
+            if extra_id == 1:
+                values = list(struct.unpack(f'<{extra_size // 8}Q', extra[4:4 + extra_size - extra_size % 8]))
+                if info.file_size == 0xFFFFFFFF and values:
+                    info.file_size = values.pop(0)
+                if info.compress_size == 0xFFFFFFFF and values:
+                    info.compress_size = values.pop(0)
+            extra = extra[4 + extra_size:]
+        infos.append(info)
+        offset += (zipfile.sizeFileHeader + fields[zipfile._FH_FILENAME_LENGTH] +
+                   fields[zipfile._FH_EXTRA_FIELD_LENGTH] + info.compress_size)
+    if offset != end_offset:
+        raise zipfile.BadZipFile(f"Offset {end_offset} is not the end of a member")
+    return infos
+
+
+def reopen_for_append(path, end_offset):
+    """
+    Open an archive that was written up to end_offset for appending, e.g. after the process writing it was killed
+    before it wrote the central directory. Everything from end_offset on is cut off, the members before it are kept
+    and new members are written after them. Returns a ZipFile in mode 'a'.
+    """
+    with open(path, 'r+b') as fp:
+        infos = scan_local_headers(fp, end_offset)
+        fp.truncate(end_offset)
+    # without an end of central directory record, zipfile appends after the existing data, and the kept members are
+    # added to the central directory it writes on close
+    zip_ref = zipfile.ZipFile(path, 'a')
+    if zip_ref.filelist:
+        zip_ref.close()
+        raise zipfile.BadZipFile(f"Unexpected central directory before offset {end_offset} in {path}")
+    for info in infos:
+        zip_ref.filelist.append(info)
+        zip_ref.NameToInfo[info.filename] = info
+    return zip_ref
+
+
+def shard_path(path, index):
+    """
+    Name of the shard with the given index, e.g. unique_images.zip -> unique_images_00003.zip
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}_{index:05d}{ext}"
+
+
+class ShardedZipWriter:
+    """
+    Keeps one output zip archive open for all writes, instead of reopening (and re-parsing the central directory of)
+    the archive for every member. If max_members or max_bytes is set, the output rolls over to a new numbered shard
+    once either limit is reached so that downstream stages can read the shards in parallel. Without limits everything
+    is written to path itself.
+    """
+
+    def __init__(self, path, compression='auto', max_members=None, max_bytes=None, mode='w'):
+        if compression not in COMPRESSION_POLICIES:
+            raise ValueError(f"Unknown compression policy '{compression}', expected one of {COMPRESSION_POLICIES}")
+        self.path = path
+        self.compression = compression
+        self.max_members = max_members
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.paths = []
+        self._zip = None
+        self._members = 0
+        self._bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _is_full(self):
+        return ((self.max_members and self._members >= self.max_members) or
+                (self.max_bytes and self._bytes >= self.max_bytes))
+
+    def _current(self):
+        if self._zip is not None and self._is_full():
+            self._zip.close()
+            self._zip = None
+        if self._zip is None:
+            sharded = self.max_members or self.max_bytes
+            path = shard_path(self.path, len(self.paths)) if sharded else self.path
+            self._zip = zipfile.ZipFile(path, self.mode)
+            self.paths.append(path)
+            self._members = 0
+            self._bytes = 0
+        return self._zip
+
+    def _new_info(self, arcname, file_size=None):
+        zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime(time.time())[:6])
+        zinfo.compress_type = compression_for(arcname, self.compression)
+        if file_size is not None:
+            # a known size lets zipfile decide up front whether the member needs zip64 extensions
+            zinfo.file_size = file_size
+        return zinfo
+
+    def _written(self, zinfo):
+        self._members += 1
+        self._bytes += zinfo.compress_size
+
+    def write_stream(self, arcname, fileobj, file_size=None):
+        """
+        Copy the contents of an open file object into the archive as arcname
+        """
+        zinfo = self._new_info(arcname, file_size)
+        with self._current().open(zinfo, 'w') as ofd:
+            shutil.copyfileobj(fileobj, ofd, COPY_CHUNK_SIZE)
+        self._written(zinfo)
+
+    def can_copy_raw(self, arcname, info):
+        """
+        Whether a member of another archive is already compressed the way the compression policy asks for arcname
+        """
+        return raw_copy_supported(info) and info.compress_type == compression_for(arcname, self.compression)
+
+    def write_raw(self, arcname, source_zip, info):
+        """
+        Copy a member of another open archive without decompressing it, if it is already compressed the way the
+        compression policy asks for. Other members are decompressed and recompressed by write_stream.
+        """
+        if self.can_copy_raw(arcname, info):
+            self._written(copy_raw_member(source_zip, info, self._current(), arcname))
+        else:
+            with source_zip.open(info, 'r') as ifd:
+                self.write_stream(arcname, ifd, file_size=info.file_size)
+
+    def writestr(self, arcname, data):
+        zinfo = self._new_info(arcname)
+        self._current().writestr(zinfo, data)
+        self._written(zinfo)
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None